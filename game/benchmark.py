@@ -0,0 +1,202 @@
+assert not __debug__  # Run with -OO
+
+import argparse
+import json
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+from direct.directnotify import DirectNotifyGlobal
+
+from make import HASH_ALGORITHMS, FunnyFarmCompilerBase
+
+# Stand-in for Panda3D's multify: packs the phase directory into a single file
+# so the resource pipeline reads and writes the same amount of data.
+STAND_IN_MULTIFY = '''import os, sys
+args = sys.argv[1:]
+filepath, phase = args[args.index('-f') + 1], args[-1]
+with open(filepath, 'wb') as out:
+    for dirpath, dirnames, filenames in os.walk(phase):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            with open(os.path.join(dirpath, filename), 'rb') as f:
+                out.write(f.read())
+'''
+
+# Stand-in for egg2bam: "converts" a model by compressing it, so converted
+# assets come out smaller like real .bam files do.
+STAND_IN_EGG2BAM = '''import sys, zlib
+args = sys.argv[1:]
+output, egg = args[args.index('-o') + 1], args[-1]
+with open(egg, 'rb') as f, open(output, 'wb') as out:
+    out.write(zlib.compress(f.read()))
+'''
+
+# Stand-in for Nuitka: "compiles" the main file by copying the pregenerated
+# binaries into <main>.dist, like a standalone build would produce.
+STAND_IN_NUITKA = '''import os, shutil, sys
+if sys.argv[1:] == ['--version']:
+    print('stand-in')
+    sys.exit(0)
+
+distDir = os.path.splitext(sys.argv[-1])[0] + '.dist'
+if os.path.exists(distDir):
+    shutil.rmtree(distDir)
+
+shutil.copytree(%r, distDir)
+'''
+
+
+class FunnyFarmCompilerBenchmark(FunnyFarmCompilerBase):
+    notify = DirectNotifyGlobal.directNotify.newCategory('FunnyFarmCompilerBenchmark')
+
+    def __init__(self, version, launcherVersion, binaries, phases):
+        FunnyFarmCompilerBase.__init__(self, version, launcherVersion)
+        self.binaries = binaries
+        self.phases = phases
+
+    def copyToBuiltDir(self):
+        distDir = os.path.join(self.workingDir, '%s.dist' % self.getMainFileName())
+        for binary in self.binaries:
+            self.copyFile(os.path.join(distDir, binary), os.path.join(self.builtDir, binary))
+
+    def getDistributables(self):
+        return self.binaries + ['resources/%s.mf' % phase for phase in self.phases]
+
+
+class FunnyFarmBenchmark:
+    notify = DirectNotifyGlobal.directNotify.newCategory('FunnyFarmBenchmark')
+
+    def __init__(self, rootDir, seed):
+        self.rootDir = rootDir
+        self.random = random.Random(seed)
+        self.binaries = []
+        self.phases = []
+
+    def generateData(self, size, entropy):
+        # A mix of random bytes and repeated text, so the data compresses
+        # roughly like real assets and binaries with the given entropy.
+        randomSize = int(size * entropy)
+        data = self.random.getrandbits(randomSize * 8).to_bytes(randomSize, 'little') if randomSize else b''
+        pattern = b'Toontown\'s Funny Farm %d\n' % self.random.randint(0, 1 << 16)
+        data += (pattern * (((size - randomSize) // len(pattern)) + 1))[:size - randomSize]
+        return data
+
+    def writeFile(self, filepath, data):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as f:
+            f.write(data)
+
+    def writeScript(self, filepath, source):
+        # The stand-ins must be directly executable, like the real multify binary.
+        self.writeFile(filepath, ('#!%s\n' % sys.executable + source).encode('utf-8'))
+        os.chmod(filepath, os.stat(filepath).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    def generate(self, phaseCount, phaseSize, filesPerPhase, binaryCount, binarySize, entropy, eggs=False):
+        self.notify.info('Generating %d phases of %d MB and %d binaries of %d MB...' % (phaseCount, phaseSize, binaryCount, binarySize))
+        baseDir = os.path.join(self.rootDir, 'Toontowns-Funny-Farm')
+        for i in range(phaseCount):
+            phase = 'phase_%d' % (i + 3)
+            self.phases.append(phase)
+            for j in range(filesPerPhase):
+                # With eggs, every other model is an .egg for the preprocessing stage to convert.
+                extension = '.egg' if eggs and j % 2 else '.bam'
+                filepath = os.path.join(baseDir, 'resources', phase, 'models', 'model_%d%s' % (j, extension))
+                self.writeFile(filepath, self.generateData(phaseSize * 1048576 // filesPerPhase, entropy))
+
+        binariesDir = os.path.join(self.rootDir, 'binaries')
+        for i in range(binaryCount):
+            binary = 'binary_%d.dll' % i
+            self.binaries.append(binary)
+            self.writeFile(os.path.join(binariesDir, binary), self.generateData(binarySize * 1048576, entropy))
+
+        self.writeFile(os.path.join(baseDir, 'toontown', 'toonbase', 'FunnyFarmStart.py'), b'pass\n')
+        self.writeFile(os.path.join(baseDir, 'config', 'release.prc'), b'server-version %GAME_VERSION%\n')
+        self.writeFile(os.path.join(self.rootDir, 'data', 'funnyfarm.py'), b'import toontown.toonbase.FunnyFarmStart\n')
+        self.writeScript(os.path.join(self.rootDir, 'funny-farm-panda3d', 'built_dev', 'bin', 'multify'), STAND_IN_MULTIFY)
+        self.writeScript(os.path.join(self.rootDir, 'nuitka'), STAND_IN_NUITKA % binariesDir)
+        self.writeScript(os.path.join(self.rootDir, 'egg2bam'), STAND_IN_EGG2BAM)
+
+    def createCompiler(self, args):
+        compiler = FunnyFarmCompilerBenchmark('ff-v1.0.0', 'v1.0.0', self.binaries, self.phases)
+        compiler.setJobs(args.jobs)
+        compiler.setForceRebuild(not args.incremental)
+        compiler.setCodec(args.codec)
+        compiler.setPacker(args.packer)
+        compiler.setManifestFormat(args.manifest_format)
+        compiler.setHashAlgorithm(args.hash_algorithm)
+        compiler.setSyncBuildFiles(args.incremental)
+        compiler.setPreprocess(args.preprocess)
+        compiler.addConverter('.egg', '.bam', [sys.executable, os.path.join(self.rootDir, 'egg2bam'), '-o', '{output}', '{input}'])
+        compiler.setCompilerCommand([sys.executable, os.path.join(self.rootDir, 'nuitka')])
+        compiler.addSourceDir('toontown')
+        compiler.setMainFile(os.path.join(compiler.dataDir, 'funnyfarm.py'))
+        compiler.setConfigFile(os.path.join('config', 'release.prc'))
+        return compiler
+
+    def run(self, args):
+        # make.py works relative to the current directory, like it does on the build boxes.
+        os.chdir(self.rootDir)
+        results = []
+        for iteration in range(args.iterations):
+            compiler = self.createCompiler(args)
+            startTime = time.perf_counter()
+            compiler.run(args.command)
+            wallTime = time.perf_counter() - startTime
+            report = compiler.metrics.getReport(args.command)
+            self.notify.info('Iteration %d: %.2fs' % (iteration + 1, wallTime))
+            for name, totals in report['summary'].items():
+                self.notify.info('  %s: %d step(s), %.2fs wall, %.2fs CPU, %.2f MB read, %.2f MB written' % (
+                    name, totals['count'], totals['wallTime'], totals['cpuTime'],
+                    totals['bytesRead'] / 1048576.0, totals['bytesWritten'] / 1048576.0))
+
+            results.append({'iteration': iteration + 1, 'wallTime': round(wallTime, 6), 'report': report})
+
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the Toontown\'s Funny Farm build pipeline against synthetic data and stand-in tools.')
+    parser.add_argument('--command', help='Build command to benchmark. (default: buildAll)', choices=['buildAll', 'buildGame', 'buildResources', 'buildDist'], default='buildAll')
+    parser.add_argument('--phases', help='Number of phase_* directories to generate. (default: 4)', type=int, default=4)
+    parser.add_argument('--phase-size', help='Size of each phase in MB. (default: 32)', type=int, default=32)
+    parser.add_argument('--files-per-phase', help='Number of files in each phase. (default: 64)', type=int, default=64)
+    parser.add_argument('--binaries', help='Number of binary distributables to generate. (default: 8)', type=int, default=8)
+    parser.add_argument('--binary-size', help='Size of each binary in MB. (default: 4)', type=int, default=4)
+    parser.add_argument('--entropy', help='Fraction of the generated data that is random. (default: 0.5)', type=float, default=0.5)
+    parser.add_argument('--seed', help='Seed for the generated data. (default: 0)', type=int, default=0)
+    parser.add_argument('--iterations', help='Number of times to run the build. (default: 3)', type=int, default=3)
+    parser.add_argument('--incremental', help='Keep caches between iterations instead of forcing full rebuilds.', action='store_true')
+    parser.add_argument('--preprocess', help='Generate .egg models and convert them with a stand-in egg2bam before packing.', action='store_true')
+    parser.add_argument('--packer', help='Pack phases with the built-in multifile writer, or the stand-in multify. (default: native)', choices=['native', 'multify'], default='native')
+    parser.add_argument('--codec', help='Compression codec for distributables. (default: bz2)', default='bz2')
+    parser.add_argument('--manifest-format', help='Manifest format to build. (default: files)', choices=['files', 'chunked'], default='files')
+    parser.add_argument('--hash-algorithm', help='Hash algorithm for the manifest. (default: md5)', choices=HASH_ALGORITHMS, default='md5')
+    parser.add_argument('--jobs', '-j', help='Number of parallel build jobs. (default: CPU count)', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--work-dir', help='Directory to generate the data in. (default: a temporary directory)')
+    parser.add_argument('--output', '-o', help='Write the results as JSON to this file.')
+    args = parser.parse_args()
+
+    FunnyFarmBenchmark.notify.setInfo(True)
+    rootDir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix='funnyfarm-benchmark-')
+    outputPath = os.path.abspath(args.output) if args.output else None
+    try:
+        benchmark = FunnyFarmBenchmark(rootDir, args.seed)
+        benchmark.generate(args.phases, args.phase_size, args.files_per_phase, args.binaries, args.binary_size, args.entropy, args.preprocess)
+        results = benchmark.run(args)
+    finally:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        if not args.work_dir:
+            shutil.rmtree(rootDir)
+
+    if outputPath:
+        with open(outputPath, 'w') as f:
+            f.write(json.dumps({'arguments': vars(args), 'results': results}, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# Startup profiling prologue. With --profile-startup, make.py compiles this
+# followed by funnyfarm.py, with a mark after each of its top-level statements,
+# and records how long each startup step takes into startup-profile.log.
+# Everything here shares a namespace with funnyfarm.py, hence the prefixes.
+import _thread
+import atexit
+import builtins
+import sys
+import time
+
+profileStartTime = time.perf_counter()
+profileMainThread = _thread.get_ident()
+profileSteps = []
+profileImports = []
+profileImportStack = []
+profileRealImport = builtins.__import__
+profileState = {'hooked': False, 'logged': False}
+
+
+def profileMark(name, stepStart):
+    profileSteps.append((name, stepStart - profileStartTime, time.perf_counter() - stepStart))
+
+
+def profileWriteLog(firstFrameTime=None):
+    if profileState['logged']:
+        return
+
+    profileState['logged'] = True
+    builtins.__import__ = profileRealImport
+    now = time.perf_counter() - profileStartTime
+    lines = ['Startup profile (%s)' % time.strftime('%Y-%m-%d %H:%M:%S')]
+    for name, start, elapsed in profileSteps:
+        lines.append('  %-32s at %10.3f ms took %10.3f ms' % (name, start * 1000, elapsed * 1000))
+
+    if firstFrameTime is None:
+        lines.append('  The first frame was never rendered.')
+    else:
+        lines.append('  %-32s at %10.3f ms' % ('first frame', firstFrameTime * 1000))
+
+    # Imports still running, like the one that started the main loop, are
+    # logged with the time they have taken so far.
+    for entry in profileImportStack:
+        entry['time'] = now - entry['start']
+        entry['name'] += ' (still importing)'
+
+    lines.append('Imports (inclusive / self):')
+    for entry in sorted(profileImports + profileImportStack, key=lambda entry: entry['start']):
+        lines.append('  %10.3f ms %10.3f ms  %s%s' % (entry['time'] * 1000, (entry['time'] - entry['children']) * 1000,
+                                                    '  ' * entry['depth'], entry['name']))
+
+    try:
+        with open('startup-profile.log', 'a') as f:
+            f.write('\n'.join(lines) + '\n\n')
+    except OSError:
+        pass
+
+
+def profileFirstFrame(task):
+    profileWriteLog(time.perf_counter() - profileStartTime)
+    return task.done
+
+
+def profileHookShowBase():
+    # The first frame is rendered by igLoop, so a task sorted right after it
+    # runs once the first frame is done.
+    module = sys.modules.get('direct.showbase.ShowBase')
+    ShowBase = getattr(module, 'ShowBase', None)
+    if not ShowBase:
+        return
+
+    profileState['hooked'] = True
+    realInit = ShowBase.__init__
+
+    def __init__(self, *args, **kwargs):
+        initStart = time.perf_counter()
+        realInit(self, *args, **kwargs)
+        profileMark('ShowBase', initStart)
+        self.taskMgr.add(profileFirstFrame, 'profileStartupFirstFrame', sort=51)
+
+    ShowBase.__init__ = __init__
+
+
+def profileImport(name, globals=None, locals=None, fromlist=(), level=0):
+    if _thread.get_ident() != profileMainThread:
+        return profileRealImport(name, globals, locals, fromlist, level)
+
+    # Only imports that load new modules are recorded, the rest are lookups.
+    modules = len(sys.modules)
+    moduleName = name
+    if level and globals and globals.get('__package__'):
+        package = globals['__package__'].rsplit('.', level - 1)[0]
+        moduleName = package + '.' + name if name else package
+
+    importStart = time.perf_counter()
+    entry = {'name': moduleName, 'depth': len(profileImportStack), 'children': 0.0, 'start': importStart - profileStartTime}
+    profileImportStack.append(entry)
+    try:
+        return profileRealImport(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - importStart
+        profileImportStack.pop()
+        if profileImportStack:
+            profileImportStack[-1]['children'] += elapsed
+
+        if len(sys.modules) > modules:
+            entry['time'] = elapsed
+            profileImports.append(entry)
+
+        if not profileState['hooked']:
+            profileHookShowBase()
+
+
+builtins.__import__ = profileImport
+atexit.register(profileWriteLog)
@@ -1,18 +1,938 @@
 assert not __debug__  # Run with -OO
 
 import argparse
+import ast
 import bz2
 from collections import OrderedDict
+import concurrent.futures
+import contextlib
+import datetime
 import hashlib
+import hmac
+import http.client
 import json
+import lzma
 import os
+import posixpath
+import queue
+import shlex
 import shutil
+import struct
 import subprocess
 import sys
+import threading
+import time
+import urllib.parse
+import zlib
 
 from cryptography.fernet import Fernet
 from direct.directnotify import DirectNotifyGlobal
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+# Distributables are streamed through the compressor in chunks of this size.
+READ_CHUNK_SIZE = 1024 * 1024
+# Files larger than this are split into blocks that are compressed in parallel.
+COMPRESS_BLOCK_SIZE = 16 * 1024 * 1024
+# Hash algorithms the patch manifest can use. md5 is what older launchers expect.
+HASH_ALGORITHMS = ['md5', 'sha256', 'blake2b']
+# Delta patches are only shipped if they are smaller than this fraction of the compressed file.
+PATCH_SIZE_RATIO = 0.8
+# bsdiff holds both files and a suffix array of the old one in memory, several
+# times the file size, so only this many patches are built at once and files
+# larger than PATCH_LARGE_SIZE bytes are diffed one at a time.
+PATCH_JOBS = 2
+PATCH_LARGE_SIZE = 128 * 1024 * 1024
+# Amount of each file that is trial compressed when picking a codec automatically.
+CODEC_SAMPLE_SIZE = 4 * 1024 * 1024
+CODEC_SAMPLE_SLICES = 4
+
+# Content-defined chunking for the chunked manifest format. A chunk boundary may
+# only follow an anchor byte, and only if the CRC of the window ending there has
+# its low bits clear. Searching for the anchor runs at C speed, and boundaries
+# depend only on nearby content, so an insertion only changes nearby chunks.
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+CHUNK_ANCHOR = b'\x5c'
+CHUNK_WINDOW_SIZE = 48
+CHUNK_MASK = (1 << 12) - 1
+
+# Subfiles with these extensions are already compressed, so the native multifile
+# packer stores them as they are.
+PRECOMPRESSED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ogg', '.mp3', '.avi', '.mp4', '.mf', '.gz', '.bz2', '.pz', '.zip')
+
+# Phases that lost files to deduplication list where they went in this subfile.
+DEDUPE_REDIRECTS_NAME = 'dedupe-redirects.json'
+# Number of phase pairs and duplicate groups listed by the duplicate report.
+DUPLICATE_REPORT_SIZE = 20
+
+# Failed uploads are retried this many times, waiting twice as long each time.
+PUBLISH_RETRIES = 3
+PUBLISH_RETRY_DELAY = 0.5
+
+# The steps recorded in the metrics that make up each stage. A stage's bytes
+# read and written are the totals of its steps. The game and resources stages
+# run at the same time, so steps are told apart by name, not by when they ran.
+STAGE_STEPS = {
+    'game': ['copyBuildFiles', 'generateGameData', 'buildGame', 'copyToBuiltDir'],
+    'resources': ['hashResources', 'convertAssets', 'stageResources', 'hashTree', 'native', 'multify', 'linkPhase'],
+    'dist': ['hash', 'compress', 'chunk', 'patch'],
+    'verify': ['verify'],
+    'analyzeDuplicates': ['hashResources'],
+    'publish': ['upload']
+}
+
+# Seconds without further changes before watch mode rebuilds, so a burst of
+# saves (or a checkout) only triggers one rebuild.
+WATCH_DEBOUNCE = 0.5
+
+# Seconds between scans when watchdog isn't available to watch with.
+WATCH_POLL_INTERVAL = 1.0
+
+# Compression codecs usable for distributables. bz2 is what older launchers
+# expect. Codecs whose streams can be concatenated may be compressed in blocks.
+# outputLimit is how the decompressor hands back input it couldn't decompress
+# within a max_length, if it takes one.
+CODECS = OrderedDict()
+CODECS['bz2'] = {
+    'extension': '.bz2',
+    'compressor': lambda: bz2.BZ2Compressor(9),
+    'decompressor': bz2.BZ2Decompressor,
+    'concatenable': True,
+    'outputLimit': 'needs_input'
+}
+CODECS['xz'] = {
+    'extension': '.xz',
+    'compressor': lambda: lzma.LZMACompressor(preset=6),
+    'decompressor': lzma.LZMADecompressor,
+    'concatenable': True,
+    'outputLimit': 'needs_input'
+}
+CODECS['zlib'] = {
+    'extension': '.zlib',
+    'compressor': lambda: zlib.compressobj(9),
+    'decompressor': zlib.decompressobj,
+    'concatenable': False,
+    'outputLimit': 'unconsumed_tail'
+}
+if zstandard:
+    CODECS['zstd'] = {
+        'extension': '.zst',
+        'compressor': lambda: zstandard.ZstdCompressor(level=19).compressobj(),
+        'decompressor': lambda: zstandard.ZstdDecompressor().decompressobj(),
+        'concatenable': True,
+        'outputLimit': None
+    }
+
+
+class FunnyFarmHashCache:
+    notify = DirectNotifyGlobal.directNotify.newCategory('FunnyFarmHashCache')
+
+    def __init__(self, cachePath, verifyContents=False, algorithm='md5'):
+        self.cachePath = cachePath
+        self.verifyContents = verifyContents
+        self.algorithm = algorithm
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not os.path.exists(self.cachePath):
+            return
+
+        try:
+            with open(self.cachePath, 'r') as f:
+                entries = json.load(f)
+
+            if not isinstance(entries, dict):
+                raise ValueError('hash cache is not a dictionary')
+        except (OSError, ValueError) as e:
+            # A corrupted cache is simply thrown away and rebuilt from scratch.
+            self.notify.warning('Hash cache is corrupted, rebuilding it: %s' % e)
+            entries = {}
+
+        self.entries = entries
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.entries, indent=4, sort_keys=True)
+
+        with open(self.cachePath + '.tmp', 'w') as f:
+            f.write(data)
+
+        os.replace(self.cachePath + '.tmp', self.cachePath)
+
+    def lookup(self, relpath, filepath, hashFile):
+        # Returns the cached entry for the file if it is unchanged, otherwise None.
+        # Normally a file is unchanged if its size and mtime match; when verifying
+        # contents the file is rehashed and compared against the cached digest.
+        stat = os.stat(filepath)
+        entry = self.entries.get(relpath)
+        # Entries from before the algorithm was recorded are all md5.
+        valid = isinstance(entry, dict) and entry.get('size') == stat.st_size and entry.get('algorithm', 'md5') == self.algorithm
+        if valid:
+            if self.verifyContents:
+                valid = entry.get('hash') == hashFile(filepath)
+            else:
+                valid = entry.get('mtime_ns') == stat.st_mtime_ns
+
+        with self.lock:
+            if valid:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if valid:
+            return entry
+
+        return None
+
+    def store(self, relpath, filepath, digest, **extra):
+        stat = os.stat(filepath)
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest, 'algorithm': self.algorithm}
+        entry.update(extra)
+        with self.lock:
+            self.entries[relpath] = entry
+
+    def report(self):
+        self.notify.info('Hash cache: %d hit(s), %d miss(es).' % (self.hits, self.misses))
+        self.hits = 0
+        self.misses = 0
+
+
+class FunnyFarmMultifile:
+    notify = DirectNotifyGlobal.directNotify.newCategory('FunnyFarmMultifile')
+
+    # Panda3D multifile format, version 1.1 (see panda/src/express/multifile.cxx).
+    # All integers are little endian. After the header comes a chain of index
+    # entries, each starting with the offset of the next, terminated by a zero
+    # offset, and then the subfile data.
+    header = b'pmf\x00\n\r'
+    majorVersion = 1
+    minorVersion = 1
+    SF_deleted = 0x0001
+    SF_compressed = 0x0008
+    SF_encrypted = 0x0010
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+    def readIndex(self):
+        # Returns the subfiles of an existing multifile, or nothing if it
+        # doesn't exist or can't be understood.
+        subfiles = OrderedDict()
+        if not os.path.exists(self.filepath):
+            return subfiles
+
+        try:
+            with open(self.filepath, 'rb') as f:
+                if f.read(len(self.header)) != self.header:
+                    return subfiles
+
+                majorVersion, minorVersion, scaleFactor = struct.unpack('<hhI', f.read(8))
+                if majorVersion != self.majorVersion or scaleFactor == 0:
+                    return subfiles
+
+                if minorVersion >= 1:
+                    f.read(4)
+
+                nextIndex = f.tell()
+                while True:
+                    f.seek(nextIndex)
+                    nextIndex = struct.unpack('<I', f.read(4))[0] * scaleFactor
+                    if not nextIndex:
+                        break
+
+                    dataStart, dataLength, flags = struct.unpack('<IIH', f.read(10))
+                    uncompressedLength = dataLength
+                    if flags & (self.SF_compressed | self.SF_encrypted):
+                        uncompressedLength = struct.unpack('<I', f.read(4))[0]
+
+                    timestamp = 0
+                    if minorVersion >= 1:
+                        timestamp = struct.unpack('<I', f.read(4))[0]
+
+                    nameLength = struct.unpack('<H', f.read(2))[0]
+                    name = bytes(c ^ 0xff for c in f.read(nameLength)).decode('utf-8')
+                    if not flags & self.SF_deleted:
+                        subfiles[name] = {'start': dataStart * scaleFactor, 'length': dataLength, 'flags': flags,
+                                          'uncompressedLength': uncompressedLength, 'timestamp': timestamp}
+        except (OSError, struct.error, UnicodeDecodeError) as e:
+            self.notify.warning('Unable to read the index of %s: %s' % (self.filepath, e))
+            return OrderedDict()
+
+        return subfiles
+
+    def write(self, subfiles, previousFilepath=None, previousLevel=None):
+        # subfiles is a list of (name, sourcePath, compressionLevel). Data is
+        # streamed from the source files, except for subfiles that are unchanged
+        # since previousFilepath was written, whose data is copied over as is.
+        # Multifiles don't record compression levels, so compressed subfiles are
+        # only reused if previousLevel, the level previousFilepath was written
+        # with, is the level they would be compressed with now.
+        entries = []
+        for name, sourcePath, compressionLevel in subfiles:
+            stat = os.stat(sourcePath)
+            entries.append({'name': name.encode('utf-8'), 'path': sourcePath, 'level': compressionLevel,
+                            'size': stat.st_size, 'timestamp': int(stat.st_mtime), 'mtime_ns': stat.st_mtime_ns})
+
+        previousIndex = FunnyFarmMultifile(previousFilepath).readIndex() if previousFilepath else {}
+        # Subfile timestamps only have a resolution of a second, so a file is
+        # only considered unchanged if it is also older than the previous multifile.
+        previousMtime = os.stat(previousFilepath).st_mtime_ns if previousIndex else 0
+        indexSize = 4
+        for entry in entries:
+            indexSize += 20 + len(entry['name']) + (4 if entry['level'] else 0)
+
+        reused = 0
+        tempFilepath = self.filepath + '.tmp'
+        previous = open(previousFilepath, 'rb') if previousIndex else None
+        try:
+            with open(tempFilepath, 'wb') as out:
+                timestamp = max([entry['timestamp'] for entry in entries] or [0])
+                out.write(self.header + struct.pack('<hhII', self.majorVersion, self.minorVersion, 1, timestamp))
+                indexStart = out.tell()
+                out.write(b'\0' * indexSize)
+                for entry in entries:
+                    entry['start'] = out.tell()
+                    old = previousIndex.get(entry['name'].decode('utf-8'))
+                    if old and old['timestamp'] == entry['timestamp'] and old['uncompressedLength'] == entry['size'] and entry['mtime_ns'] < previousMtime and \
+                            not old['flags'] & self.SF_encrypted and bool(old['flags'] & self.SF_compressed) == bool(entry['level']) and \
+                            (not entry['level'] or entry['level'] == previousLevel):
+                        previous.seek(old['start'])
+                        remaining = old['length']
+                        while remaining:
+                            data = previous.read(min(remaining, READ_CHUNK_SIZE))
+                            if not data:
+                                raise EOFError('%s is truncated' % previousFilepath)
+
+                            out.write(data)
+                            remaining -= len(data)
+
+                        reused += 1
+                    else:
+                        compressor = zlib.compressobj(entry['level']) if entry['level'] else None
+                        with open(entry['path'], 'rb') as f:
+                            for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+                                out.write(compressor.compress(chunk) if compressor else chunk)
+
+                        if compressor:
+                            out.write(compressor.flush())
+
+                    entry['length'] = out.tell() - entry['start']
+                    if out.tell() > 0xffffffff:
+                        raise ValueError('%s is too large for a multifile' % self.filepath)
+
+                index = b''
+                for entry in entries:
+                    flags = self.SF_compressed if entry['level'] else 0
+                    record = struct.pack('<IIH', entry['start'], entry['length'], flags)
+                    if flags:
+                        record += struct.pack('<I', entry['size'])
+
+                    record += struct.pack('<IH', entry['timestamp'], len(entry['name'])) + bytes(c ^ 0xff for c in entry['name'])
+                    index += struct.pack('<I', indexStart + len(index) + 4 + len(record)) + record
+
+                out.seek(indexStart)
+                out.write(index + struct.pack('<I', 0))
+        finally:
+            if previous:
+                previous.close()
+
+        os.replace(tempFilepath, self.filepath)
+        return reused
+
+
+class FunnyFarmResourceStore:
+    notify = DirectNotifyGlobal.directNotify.newCategory('FunnyFarmResourceStore')
+
+    def __init__(self, storeDir):
+        self.storeDir = storeDir
+        self.packed = set()
+        self.lock = threading.Lock()
+
+    def getPath(self, phase, key):
+        # Multifiles don't depend on the platform or architecture, only on the
+        # phase tree and the packing options, which together make up the key.
+        return os.path.join(self.storeDir, phase, key + '.mf')
+
+    def contains(self, phase, key, force=False):
+        # A forced build only trusts the entries it packed itself, so building
+        # several targets in one invocation still packs every phase only once.
+        if force:
+            with self.lock:
+                if (phase, key) not in self.packed:
+                    return False
+
+        return os.path.exists(self.getPath(phase, key))
+
+    def add(self, phase, key):
+        with self.lock:
+            self.packed.add((phase, key))
+
+
+class FunnyFarmPublishTargetBase:
+    notify = DirectNotifyGlobal.directNotify.newCategory('FunnyFarmPublishTargetBase')
+
+    # Objects are named by their path relative to the dist directory, with
+    # forward slashes. Targets must be safe to use from several threads.
+    def readFile(self, name):
+        # Returns the contents of the object, or None if it doesn't exist.
+        raise NotImplementedError('readFile')
+
+    def uploadFile(self, name, sourcePath):
+        raise NotImplementedError('uploadFile')
+
+    def close(self):
+        pass
+
+
+class FunnyFarmPublishTargetLocal(FunnyFarmPublishTargetBase):
+    notify = DirectNotifyGlobal.directNotify.newCategory('FunnyFarmPublishTargetLocal')
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def readFile(self, name):
+        filepath = os.path.join(self.directory, *name.split('/'))
+        if not os.path.exists(filepath):
+            return None
+
+        with open(filepath, 'rb') as f:
+            return f.read()
+
+    def uploadFile(self, name, sourcePath):
+        # Copied next to the destination and swapped in, so readers never see a partial file.
+        destPath = os.path.join(self.directory, *name.split('/'))
+        os.makedirs(os.path.dirname(destPath), exist_ok=True)
+        tempPath = '%s.%d.tmp' % (destPath, threading.get_ident())
+        shutil.copyfile(sourcePath, tempPath)
+        os.replace(tempPath, destPath)
+
+
+class FunnyFarmPublishTargetHTTP(FunnyFarmPublishTargetBase):
+    notify = DirectNotifyGlobal.directNotify.newCategory('FunnyFarmPublishTargetHTTP')
+
+    # Statuses a GET answers with when the object doesn't exist.
+    MISSING_STATUSES = (404,)
+
+    def __init__(self, url, headers=None):
+        url = urllib.parse.urlsplit(url)
+        self.secure = url.scheme.endswith('https')
+        self.host = url.netloc
+        self.basePath = url.path.rstrip('/')
+        self.headers = headers or {}
+        self.connections = threading.local()
+        self.openConnections = []
+        self.lock = threading.Lock()
+
+    def getConnection(self):
+        # Every thread keeps its own connection alive for all of its requests.
+        connection = getattr(self.connections, 'connection', None)
+        if not connection:
+            if self.secure:
+                connection = http.client.HTTPSConnection(self.host, timeout=60)
+            else:
+                connection = http.client.HTTPConnection(self.host, timeout=60)
+
+            self.connections.connection = connection
+            with self.lock:
+                self.openConnections.append(connection)
+
+        return connection
+
+    def getHeaders(self, method, path):
+        return dict(self.headers)
+
+    def request(self, method, name, sourcePath=None):
+        # Returns the status and body of the response. Connection errors, server
+        # errors and throttling are retried; anything else is up to the caller.
+        path = self.basePath + '/' + urllib.parse.quote(name)
+        error = None
+        for attempt in range(PUBLISH_RETRIES + 1):
+            if attempt:
+                time.sleep(PUBLISH_RETRY_DELAY * 2 ** (attempt - 1))
+
+            connection = self.getConnection()
+            headers = self.getHeaders(method, path)
+            try:
+                if sourcePath:
+                    headers['Content-Length'] = str(os.path.getsize(sourcePath))
+                    with open(sourcePath, 'rb') as f:
+                        connection.request(method, path, body=f, headers=headers)
+                        response = connection.getresponse()
+                else:
+                    connection.request(method, path, headers=headers)
+                    response = connection.getresponse()
+
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                # The connection is in an unknown state now, start a new one.
+                connection.close()
+                self.connections.connection = None
+                error = e
+                continue
+
+            if response.status >= 500 or response.status == 429:
+                error = 'HTTP %d %s' % (response.status, response.reason)
+                continue
+
+            return response.status, data
+
+        raise IOError('%s %s failed after %d attempts: %s' % (method, path, PUBLISH_RETRIES + 1, error))
+
+    def readFile(self, name):
+        status, data = self.request('GET', name)
+        if status in self.MISSING_STATUSES:
+            return None
+
+        if status >= 300:
+            raise IOError('GET %s failed: HTTP %d' % (name, status))
+
+        return data
+
+    def uploadFile(self, name, sourcePath):
+        status, data = self.request('PUT', name, sourcePath)
+        if status >= 300:
+            raise IOError('PUT %s failed: HTTP %d' % (name, status))
+
+    def close(self):
+        with self.lock:
+            for connection in self.openConnections:
+                connection.close()
+
+            self.openConnections = []
+
+
+class FunnyFarmPublishTargetS3(FunnyFarmPublishTargetHTTP):
+    notify = DirectNotifyGlobal.directNotify.newCategory('FunnyFarmPublishTargetS3')
+
+    # S3 only answers 404 for a missing key if the credentials may list the
+    # bucket, and 403 otherwise. Upload-only credentials are the norm here.
+    MISSING_STATUSES = (403, 404)
+
+    # Path style requests (endpoint/bucket/key) signed with AWS Signature
+    # Version 4, which works with S3 and S3-compatible servers alike.
+    def __init__(self, url, accessKey, secretKey, region='us-east-1', headers=None):
+        FunnyFarmPublishTargetHTTP.__init__(self, url, headers)
+        self.accessKey = accessKey
+        self.secretKey = secretKey
+        self.region = region
+
+    def sign(self, key, message):
+        return hmac.new(key, message.encode('utf-8'), hashlib.sha256).digest()
+
+    def getHeaders(self, method, path):
+        # The payload is streamed from disk, so it is left unsigned.
+        now = datetime.datetime.utcnow()
+        amzDate = now.strftime('%Y%m%dT%H%M%SZ')
+        dateStamp = now.strftime('%Y%m%d')
+        headers = FunnyFarmPublishTargetHTTP.getHeaders(self, method, path)
+        headers['x-amz-content-sha256'] = 'UNSIGNED-PAYLOAD'
+        headers['x-amz-date'] = amzDate
+        signedHeaders = 'host;x-amz-content-sha256;x-amz-date'
+        canonicalHeaders = 'host:%s\nx-amz-content-sha256:UNSIGNED-PAYLOAD\nx-amz-date:%s\n' % (self.host, amzDate)
+        canonicalRequest = '\n'.join([method, path, '', canonicalHeaders, signedHeaders, 'UNSIGNED-PAYLOAD'])
+        scope = '%s/%s/s3/aws4_request' % (dateStamp, self.region)
+        stringToSign = '\n'.join(['AWS4-HMAC-SHA256', amzDate, scope, hashlib.sha256(canonicalRequest.encode('utf-8')).hexdigest()])
+        signingKey = self.sign(('AWS4' + self.secretKey).encode('utf-8'), dateStamp)
+        for part in (self.region, 's3', 'aws4_request'):
+            signingKey = self.sign(signingKey, part)
+
+        signature = hmac.new(signingKey, stringToSign.encode('utf-8'), hashlib.sha256).hexdigest()
+        headers['Authorization'] = 'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s' % (
+            self.accessKey, scope, signedHeaders, signature)
+        return headers
+
+
+class FunnyFarmFileWatcher:
+    notify = DirectNotifyGlobal.directNotify.newCategory('FunnyFarmFileWatcher')
+
+    # watchdog event types that mean something changed. Files being opened and
+    # read (by the build itself, among others) are ignored.
+    CHANGE_EVENTS = ('created', 'deleted', 'modified', 'moved', 'closed')
+
+    def __init__(self, paths, pollInterval=WATCH_POLL_INTERVAL):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.pollInterval = pollInterval
+        self.observer = None
+        self.events = queue.Queue()
+        self.snapshot = {}
+
+    def start(self):
+        # watchdog uses the platform's change notifications: ReadDirectoryChangesW
+        # on Windows, FSEvents on macOS and inotify on Linux.
+        if Observer:
+            try:
+                self.startObserver()
+                return
+            except OSError as e:
+                # Usually a limit on the number of watches was reached.
+                self.close()
+                self.notify.warning('Unable to watch for changes, polling instead: %s' % e)
+        else:
+            self.notify.warning('watchdog is not installed, polling for changes instead. Run "pip install watchdog" to fix this.')
+
+        self.snapshot = self.scan()
+
+    def startObserver(self):
+        # Files are watched through their parent directory, since editors often
+        # replace a file instead of writing to it.
+        self.observer = Observer()
+        directories = set()
+        for path in self.paths:
+            if os.path.isdir(path):
+                directories.add((path, True))
+            elif os.path.isdir(os.path.dirname(path)):
+                directories.add((os.path.dirname(path), False))
+
+        for directory, recursive in sorted(directories):
+            self.observer.schedule(self, directory, recursive=recursive)
+
+        self.observer.start()
+
+    def dispatch(self, event):
+        # Called by the observer's thread for every event.
+        if event.event_type in self.CHANGE_EVENTS:
+            self.events.put(os.fsdecode(event.src_path))
+            if getattr(event, 'dest_path', None):
+                self.events.put(os.fsdecode(event.dest_path))
+
+    def isWatched(self, path):
+        for watchedPath in self.paths:
+            if path == watchedPath or path.startswith(watchedPath + os.sep):
+                return True
+
+        return False
+
+    def readEvents(self, timeout):
+        # Without a timeout this still only waits one poll interval, since
+        # Ctrl+C can't interrupt the wait on Windows.
+        try:
+            paths = [self.events.get(timeout=self.pollInterval if timeout is None else timeout)]
+        except queue.Empty:
+            return set()
+
+        while True:
+            try:
+                paths.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+
+        return set(path for path in paths if self.isWatched(path))
+
+    def scan(self):
+        # Maps every watched file to its mtime and size.
+        snapshot = {}
+        for path in self.paths:
+            if os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    for filename in filenames:
+                        filepath = os.path.join(dirpath, filename)
+                        try:
+                            stat = os.stat(filepath)
+                        except OSError:
+                            continue
+
+                        snapshot[filepath] = (stat.st_mtime_ns, stat.st_size)
+            elif os.path.exists(path):
+                stat = os.stat(path)
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+
+        return snapshot
+
+    def readPolling(self, timeout):
+        time.sleep(self.pollInterval if timeout is None else min(timeout, self.pollInterval))
+        snapshot = self.scan()
+        changes = set(path for path in set(snapshot) | set(self.snapshot) if snapshot.get(path) != self.snapshot.get(path))
+        self.snapshot = snapshot
+        return changes
+
+    def readChanges(self, timeout=None):
+        # Returns the paths that changed within the timeout. Without a timeout,
+        # returns after one scan or poll interval, whether anything changed or not.
+        if self.observer is not None:
+            return self.readEvents(timeout)
+
+        return self.readPolling(timeout)
+
+    def waitForChanges(self, debounce=WATCH_DEBOUNCE):
+        # Blocks until something changes, then keeps collecting changes until
+        # nothing else changed for the debounce time.
+        changes = set()
+        while not changes:
+            changes = self.readChanges()
+
+        while True:
+            moreChanges = self.readChanges(debounce)
+            if not moreChanges:
+                return changes
+
+            changes.update(moreChanges)
+
+    def close(self):
+        if self.observer is not None:
+            if self.observer.is_alive():
+                self.observer.stop()
+                self.observer.join()
+
+            self.observer = None
+
+
+class FunnyFarmBuildMetrics:
+    notify = DirectNotifyGlobal.directNotify.newCategory('FunnyFarmBuildMetrics')
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+        self.startTime = time.perf_counter()
+        self.startCpuTime = time.process_time()
+        self.startDate = datetime.datetime.now()
+
+    def getChildCpuTime(self):
+        # CPU time of finished child processes. Only available on POSIX, and
+        # approximate when several steps spawning processes overlap.
+        if not resource:
+            return None
+
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    def begin(self, name, target=None):
+        record = OrderedDict()
+        record['name'] = name
+        record['target'] = target
+        record['start'] = time.perf_counter()
+        record['cpuStart'] = time.thread_time()
+        record['childCpuStart'] = self.getChildCpuTime()
+        return record
+
+    def end(self, record, bytesRead=None, bytesWritten=None, failed=False):
+        # cpuTime only covers the thread running the step; work it hands off to
+        # other threads or processes is not included.
+        wallTime = time.perf_counter() - record.pop('start')
+        record['offset'] = round(time.perf_counter() - wallTime - self.startTime, 6)
+        record['wallTime'] = round(wallTime, 6)
+        record['cpuTime'] = round(time.thread_time() - record.pop('cpuStart'), 6)
+        childCpuStart = record.pop('childCpuStart')
+        if childCpuStart is not None:
+            record['childCpuTime'] = round(self.getChildCpuTime() - childCpuStart, 6)
+
+        record['bytesRead'] = bytesRead
+        record['bytesWritten'] = bytesWritten
+        transferred = max(bytesRead or 0, bytesWritten or 0)
+        record['throughput'] = round(transferred / 1048576.0 / max(wallTime, 1e-6), 3) if transferred else None
+        if failed:
+            record['failed'] = True
+
+        with self.lock:
+            self.records.append(record)
+
+        return record
+
+    def getTotals(self, names, since):
+        # Returns the bytes read and written by the named steps that started
+        # since the given offset.
+        bytesRead = bytesWritten = 0
+        with self.lock:
+            for record in self.records:
+                if record['name'] in names and record['offset'] >= since:
+                    bytesRead += record['bytesRead'] or 0
+                    bytesWritten += record['bytesWritten'] or 0
+
+        return bytesRead, bytesWritten
+
+    @contextlib.contextmanager
+    def measure(self, name, target=None):
+        # Yields a dict the caller can fill in with bytesRead and bytesWritten.
+        # Steps that raise are recorded too, marked as failed.
+        record = self.begin(name, target)
+        sizes = {}
+        failed = True
+        try:
+            yield sizes
+            failed = False
+        finally:
+            self.end(record, sizes.get('bytesRead'), sizes.get('bytesWritten'), failed)
+
+    def getReport(self, command, error=None):
+        summary = OrderedDict()
+        with self.lock:
+            records = list(self.records)
+
+        for record in records:
+            totals = summary.setdefault(record['name'], OrderedDict([('count', 0), ('wallTime', 0), ('cpuTime', 0), ('bytesRead', 0), ('bytesWritten', 0)]))
+            totals['count'] += 1
+            totals['wallTime'] = round(totals['wallTime'] + record['wallTime'], 6)
+            totals['cpuTime'] = round(totals['cpuTime'] + record['cpuTime'], 6)
+            totals['bytesRead'] += record['bytesRead'] or 0
+            totals['bytesWritten'] += record['bytesWritten'] or 0
+
+        report = OrderedDict()
+        report['command'] = command
+        report['status'] = 'failed' if error else 'succeeded'
+        if error:
+            report['error'] = '%s: %s' % (type(error).__name__, error)
+
+        report['date'] = self.startDate.isoformat()
+        report['wallTime'] = round(time.perf_counter() - self.startTime, 6)
+        report['cpuTime'] = round(time.process_time() - self.startCpuTime, 6)
+        report['summary'] = summary
+        report['steps'] = records
+        return report
+
+    def writeReport(self, reportPath, command, error=None):
+        os.makedirs(os.path.dirname(reportPath), exist_ok=True)
+        with open(reportPath, 'w') as f:
+            f.write(json.dumps(self.getReport(command, error), indent=4))
+
+        self.notify.info('Build metrics written to %s.' % reportPath)
+
+
+class FunnyFarmBuildStage:
+
+    def __init__(self, name, function, dependencies=(), inputs=None, outputs=None, options=None):
+        # inputs and outputs are callables returning lists of paths, and options
+        # a callable returning the build options the outputs depend on. They are
+        # only evaluated once the stages this one depends on have finished.
+        # Stages that don't declare their inputs and outputs always run.
+        self.name = name
+        self.function = function
+        self.dependencies = list(dependencies)
+        self.inputs = inputs
+        self.outputs = outputs
+        self.options = options
+
+
+class FunnyFarmStageScheduler:
+    notify = DirectNotifyGlobal.directNotify.newCategory('FunnyFarmStageScheduler')
+
+    def __init__(self, stampsPath=None, hashFiles=None, force=False):
+        # The fingerprints of every stage's last successful run are kept in
+        # stampsPath. hashFiles returns the digests of a list of files.
+        self.stages = OrderedDict()
+        self.stampsPath = stampsPath
+        self.hashFiles = hashFiles
+        self.force = force
+        self.stamps = {}
+        self.lock = threading.Lock()
+        if stampsPath and os.path.exists(stampsPath):
+            try:
+                with open(stampsPath, 'r') as f:
+                    self.stamps = json.load(f)
+            except (OSError, ValueError):
+                self.notify.warning('Stage fingerprints are unreadable, every stage will run.')
+
+    def addStage(self, stage):
+        for dependency in stage.dependencies:
+            if dependency not in self.stages:
+                self.notify.error('Stage %s depends on unknown stage %s!' % (stage.name, dependency))
+
+        self.stages[stage.name] = stage
+
+    def getFingerprint(self, paths, options=None):
+        # Covers the path and contents of every file, so added, removed and
+        # modified files all change the fingerprint, and the options if given.
+        filepaths = []
+        for path in sorted(set(paths)):
+            if os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    dirnames.sort()
+                    filepaths += [os.path.join(dirpath, filename) for filename in sorted(filenames)]
+            elif os.path.exists(path):
+                filepaths.append(path)
+
+        fingerprint = hashlib.md5()
+        for filepath, digest in zip(filepaths, self.hashFiles(filepaths)):
+            fingerprint.update(('%s\0%s\n' % (filepath, digest)).encode('utf-8'))
+
+        if options is not None:
+            fingerprint.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+
+        return fingerprint.hexdigest()
+
+    def isUpToDate(self, stage, inputFingerprint):
+        # A stage is up to date if its inputs and options match its last successful
+        # run, and its outputs are all still there, unchanged since that run.
+        stamp = self.stamps.get(stage.name)
+        if not isinstance(stamp, dict) or stamp.get('inputs') != inputFingerprint:
+            return False
+
+        outputs = stage.outputs()
+        if not outputs or not all(os.path.exists(output) for output in outputs):
+            return False
+
+        return self.getFingerprint(outputs) == stamp.get('outputs')
+
+    def setStamp(self, name, stamp):
+        with self.lock:
+            if stamp is None:
+                self.stamps.pop(name, None)
+            else:
+                self.stamps[name] = stamp
+
+            data = json.dumps(self.stamps, indent=4, sort_keys=True)
+            with open(self.stampsPath + '.tmp', 'w') as f:
+                f.write(data)
+
+            os.replace(self.stampsPath + '.tmp', self.stampsPath)
+
+    def runStage(self, stage):
+        inputFingerprint = None
+        if self.stampsPath and stage.inputs is not None and stage.outputs is not None:
+            inputFingerprint = self.getFingerprint(stage.inputs(), stage.options() if stage.options else None)
+            if not self.force and self.isUpToDate(stage, inputFingerprint):
+                self.notify.info('Stage %s is up to date, skipping.' % stage.name)
+                return
+
+            # A failed run may leave its outputs half written, so the stage is
+            # forgotten until it succeeds again.
+            self.setStamp(stage.name, None)
+
+        self.notify.info('Starting stage %s...' % stage.name)
+        startTime = time.perf_counter()
+        stage.function()
+        self.notify.info('Stage %s finished in %.2fs.' % (stage.name, time.perf_counter() - startTime))
+        if inputFingerprint is not None:
+            self.setStamp(stage.name, {'inputs': inputFingerprint, 'outputs': self.getFingerprint(stage.outputs())})
+
+    def run(self):
+        # Every stage starts as soon as all of its dependencies are done, so
+        # independent stages run at the same time.
+        done = set()
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.stages))) as executor:
+            while len(done) < len(self.stages):
+                for name, stage in self.stages.items():
+                    if name not in done and name not in running.values() and all(dependency in done for dependency in stage.dependencies):
+                        running[executor.submit(self.runStage, stage)] = name
+
+                finished, pending = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except:
+                        # Let the stages that are already running finish, but don't start any more.
+                        self.notify.warning('Stage %s failed!' % name)
+                        raise
+
+                    done.add(name)
+
 
 class FunnyFarmCompilerBase:
     notify = DirectNotifyGlobal.directNotify.newCategory('FunnyFarmCompilerBase')
@@ -30,6 +950,108 @@ class FunnyFarmCompilerBase:
         self.sourceDirs = []
         self.mainFile = None
         self.configFile = None
+        self.jobs = os.cpu_count() or 1
+        self.forceRebuild = False
+        self.compressBlockSize = COMPRESS_BLOCK_SIZE
+        self.verifyHashCache = False
+        self.hashCache = None
+        self.hashCaches = {}
+        # In watch mode, the files hashed for tree hashes are remembered by
+        # size and mtime, so a rebuild only reads the files that changed.
+        self.treeHashCache = None
+        self.compilerVersion = None
+        self.hashAlgorithm = 'md5'
+        self.hashExecutor = None
+        self.hashExecutorLock = threading.Lock()
+        self.readBuffers = threading.local()
+        self.deltaFrom = None
+        self.deltaManifest = None
+        self.patchLargeSize = PATCH_LARGE_SIZE
+        self.largePatchLock = threading.Lock()
+        self.codec = 'bz2'
+        self.minDecompressSpeed = 0
+        self.manifestFormat = 'files'
+        self.syncBuildFiles = False
+        self.packer = 'native'
+        self.multifileCompressionLevel = 0
+        self.resourceStore = None
+        self.preprocess = False
+        self.dedupeResources = False
+        self.profileStartup = False
+        self.converters = OrderedDict()
+        self.compilerCommand = None
+        # Phases the game needs to launch, downloaded along with the binaries
+        # before anything else. The remaining phases download in the background.
+        self.launchPhases = ['phase_3', 'phase_3.5']
+        self.publishTarget = None
+        self.metrics = FunnyFarmBuildMetrics()
+        self.compilerFlags = ['--standalone', '--file-reference-choice=frozen', '--show-progress', '--show-scons', '--follow-imports', '--python-flag=-S,-OO']
+
+    def setJobs(self, jobs):
+        self.jobs = max(1, jobs)
+
+    def setForceRebuild(self, forceRebuild):
+        self.forceRebuild = forceRebuild
+
+    def setCompressBlockSize(self, compressBlockSize):
+        self.compressBlockSize = compressBlockSize
+
+    def setVerifyHashCache(self, verifyHashCache):
+        self.verifyHashCache = verifyHashCache
+
+    def setHashAlgorithm(self, hashAlgorithm):
+        if hashAlgorithm not in HASH_ALGORITHMS:
+            self.notify.error('Unknown hash algorithm: %s' % hashAlgorithm)
+
+        self.hashAlgorithm = hashAlgorithm
+
+    def setDeltaFrom(self, deltaFrom):
+        self.deltaFrom = deltaFrom
+
+    def setPatchLargeSize(self, patchLargeSize):
+        self.patchLargeSize = patchLargeSize
+
+    def setCodec(self, codec):
+        if codec != 'auto' and codec not in CODECS:
+            self.notify.error('Compression codec %s is not available!' % codec)
+
+        self.codec = codec
+
+    def setMinDecompressSpeed(self, minDecompressSpeed):
+        self.minDecompressSpeed = minDecompressSpeed
+
+    def setManifestFormat(self, manifestFormat):
+        self.manifestFormat = manifestFormat
+
+    def setSyncBuildFiles(self, syncBuildFiles):
+        self.syncBuildFiles = syncBuildFiles
+
+    def setPacker(self, packer):
+        self.packer = packer
+
+    def setMultifileCompressionLevel(self, multifileCompressionLevel):
+        self.multifileCompressionLevel = multifileCompressionLevel
+
+    def setResourceStore(self, resourceStore):
+        self.resourceStore = resourceStore
+
+    def setDedupeResources(self, dedupeResources):
+        self.dedupeResources = dedupeResources
+
+    def setPreprocess(self, preprocess):
+        self.preprocess = preprocess
+
+    def addConverter(self, sourceExtension, targetExtension, command):
+        # command is a list of arguments in which {input} and {output} are
+        # replaced with the paths of the asset and the converted file.
+        self.converters[sourceExtension.lower()] = (targetExtension, command)
+
+    def setPublishTarget(self, publishTarget):
+        self.publishTarget = publishTarget
+
+    def setCompilerCommand(self, compilerCommand):
+        # Replaces the command used to invoke Nuitka, e.g. with a stand-in for testing.
+        self.compilerCommand = compilerCommand
 
     def addSourceDir(self, sourceDir):
         if sourceDir not in self.sourceDirs:
@@ -38,14 +1060,89 @@ class FunnyFarmCompilerBase:
     def setMainFile(self, mainFile):
         self.mainFile = mainFile
 
+    def setProfileStartup(self, profileStartup):
+        self.profileStartup = profileStartup
+
     def setConfigFile(self, configFile):
         self.configFile = configFile
 
-    def removeOldBuildFiles(self):
+    def getMainFileName(self):
+        return os.path.splitext(os.path.basename(self.mainFile))[0]
+
+    def getEntryPointFiles(self):
+        # The files the compiled main file is made of. Profiling builds prepend
+        # the profiling prologue to the main file.
+        if self.profileStartup:
+            return [os.path.join(self.dataDir, 'funnyfarmprofile.py'), self.mainFile]
+
+        return [self.mainFile]
+
+    def instrumentEntryPoint(self, prologue, source):
+        # Generated from the main file every build, so profiling builds never
+        # fall behind it. Each top-level statement is followed by a mark.
+        lines = [prologue.rstrip('\n'), '', '', '# %s, instrumented by make.py' % os.path.basename(self.mainFile)]
+        for statement in ast.parse(source).body:
+            segment = ast.get_source_segment(source, statement)
+            for decorator in reversed(getattr(statement, 'decorator_list', [])):
+                segment = '@%s\n%s' % (ast.get_source_segment(source, decorator), segment)
+
+            name = 'line %d: %s' % (statement.lineno, segment.split('\n')[0])
+            lines += ['profileStepStart = time.perf_counter()', segment, 'profileMark(%r, profileStepStart)' % name[:48]]
+
+        return '\n'.join(lines) + '\n'
+
+    def getEntryPointSource(self):
+        sources = []
+        for filepath in self.getEntryPointFiles():
+            with open(filepath, 'r') as f:
+                sources.append(f.read())
+
+        if self.profileStartup:
+            return self.instrumentEntryPoint(*sources)
+
+        return sources[0]
+
+    def copyEntryPoint(self, allowLink=False):
+        # Brings the main file in the working directory up to date, like syncFile.
+        destPath = os.path.join(self.workingDir, os.path.basename(self.mainFile))
+        if not self.profileStartup:
+            return self.syncFile(self.mainFile, destPath, allowLink)
+
+        source = self.getEntryPointSource()
+        if os.path.exists(destPath):
+            with open(destPath, 'r') as f:
+                if f.read() == source:
+                    return 'unchanged'
+
+            # Never write through the old file, it may be a hardlink to the main file.
+            os.remove(destPath)
+
+        os.makedirs(self.workingDir, exist_ok=True)
+        with open(destPath, 'w') as f:
+            f.write(source)
+
+        return 'copied'
+
+    def getPreservedBuildItems(self):
+        # Items in the working directory that survive cleaning up old build files.
+        # The Nuitka build directory contains cache which will speed up the build
+        # process, and the dist directory is reused if the game is up to date.
+        items = ['built', 'hashcache.json', 'metrics', 'preprocessed', 'preprocess-hashcache.json', 'preprocess-report.json',
+                 'resources-hashcache.json', 'duplicates.json', 'dedupe', 'stages.json', 'stages-hashcache.json']
+        if self.mainFile:
+            mainFileName = self.getMainFileName()
+            items += ['%s.build' % mainFileName, '%s.dist' % mainFileName, '%s.fingerprint' % mainFileName]
+
+        return items
+
+    def removeOldBuildFiles(self, keepItems=()):
         if os.path.exists(self.workingDir):
             self.notify.info('Cleaning up old build files...')
+            preservedItems = self.getPreservedBuildItems() + list(keepItems)
             for item in os.listdir(self.workingDir):
-                if item == 'built':
+                # With --all the resources are built at the same time, and save
+                # their hash caches through a temp file next to the preserved one.
+                if item in preservedItems or (item.endswith('.tmp') and item[:-len('.tmp')] in preservedItems):
                     continue
 
                 itemPath = os.path.join(self.workingDir, item)
@@ -54,20 +1151,151 @@ class FunnyFarmCompilerBase:
                 else:
                     os.remove(itemPath)
 
+    def syncFile(self, sourcePath, destPath, allowLink=False):
+        # Brings destPath up to date with sourcePath, leaving it untouched
+        # (mtime included) if it already has the same contents.
+        sourceStat = os.stat(sourcePath)
+        try:
+            destStat = os.stat(destPath)
+        except FileNotFoundError:
+            destStat = None
+
+        if destStat:
+            if (sourceStat.st_dev, sourceStat.st_ino) == (destStat.st_dev, destStat.st_ino):
+                return 'unchanged'
+
+            if sourceStat.st_size == destStat.st_size:
+                if sourceStat.st_mtime_ns == destStat.st_mtime_ns:
+                    return 'unchanged'
+
+                if self.getFileHash(sourcePath) == self.getFileHash(destPath):
+                    return 'unchanged'
+
+            # Never write through the old file, it may be a hardlink to a source file.
+            os.remove(destPath)
+        else:
+            os.makedirs(os.path.dirname(destPath), exist_ok=True)
+
+        if allowLink and sourceStat.st_dev == os.stat(os.path.dirname(destPath)).st_dev:
+            try:
+                os.link(sourcePath, destPath)
+                return 'linked'
+            except OSError:
+                # Not every filesystem supports hardlinks, just copy instead.
+                pass
+
+        shutil.copy2(sourcePath, destPath)
+        return 'copied'
+
+    def linkFile(self, sourcePath, destPath):
+        # Replaces destPath with a hardlink to sourcePath, or a copy where that
+        # isn't possible. The old file is swapped out, never written through.
+        tempPath = destPath + '.tmp'
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+
+        try:
+            os.link(sourcePath, tempPath)
+        except OSError:
+            shutil.copy2(sourcePath, tempPath)
+
+        os.replace(tempPath, destPath)
+
+    def syncTree(self, sourceDir, destDir, allowLink=False):
+        # Mirrors sourceDir into destDir, only touching files that changed and
+        # deleting anything that no longer exists in sourceDir.
+        stats = {'unchanged': 0, 'linked': 0, 'copied': 0, 'removed': 0, 'bytes': 0}
+        for dirpath, dirnames, filenames in os.walk(sourceDir):
+            relDir = os.path.relpath(dirpath, sourceDir)
+            destDirpath = os.path.normpath(os.path.join(destDir, relDir))
+            if os.path.isfile(destDirpath):
+                os.remove(destDirpath)
+
+            os.makedirs(destDirpath, exist_ok=True)
+            for filename in filenames:
+                destPath = os.path.join(destDirpath, filename)
+                if os.path.isdir(destPath):
+                    shutil.rmtree(destPath)
+
+                status = self.syncFile(os.path.join(dirpath, filename), destPath, allowLink)
+                stats[status] += 1
+                if status != 'unchanged':
+                    stats['bytes'] += os.path.getsize(destPath)
+
+        for dirpath, dirnames, filenames in os.walk(destDir, topdown=False):
+            relDir = os.path.relpath(dirpath, destDir)
+            sourceDirpath = os.path.normpath(os.path.join(sourceDir, relDir))
+            for filename in filenames:
+                if not os.path.isfile(os.path.join(sourceDirpath, filename)):
+                    os.remove(os.path.join(dirpath, filename))
+                    stats['removed'] += 1
+
+            if not os.path.isdir(sourceDirpath):
+                os.rmdir(dirpath)
+
+        return stats
+
+    def copyFile(self, sourcePath, destPath):
+        if os.path.isdir(destPath):
+            destPath = os.path.join(destPath, os.path.basename(sourcePath))
+
+        if self.syncBuildFiles:
+            # Files in the built directory may be modified in place afterwards
+            # (see fixMacLibs), so these are always real copies.
+            self.syncFile(sourcePath, destPath)
+        else:
+            shutil.copy(sourcePath, destPath)
+
     def copyBuildFiles(self):
+        # Returns the number of bytes copied.
+        if self.syncBuildFiles:
+            return self.syncBuildSourceFiles()
+
         self.removeOldBuildFiles()
         self.notify.info('Copying build files...')
+        bytesCopied = 0
         for sourceDir in self.sourceDirs:
             filepath = os.path.join(self.baseDir, sourceDir)
             if not os.path.exists(filepath):
                 continue
 
             shutil.copytree(filepath, os.path.join(self.workingDir, sourceDir))
+            bytesCopied += self.getTreeSize(os.path.join(self.workingDir, sourceDir))
 
         if os.path.exists(self.mainFile):
-            shutil.copy(self.mainFile, self.workingDir)
+            self.copyEntryPoint()
+            bytesCopied += os.path.getsize(os.path.join(self.workingDir, os.path.basename(self.mainFile)))
 
         self.notify.info('Build files copied successfully.')
+        return bytesCopied
+
+    def syncBuildSourceFiles(self):
+        # Unlike copyBuildFiles, this keeps the previous copy of the sources and
+        # only updates what changed, so unchanged files keep their mtimes.
+        self.removeOldBuildFiles(self.sourceDirs + [os.path.basename(self.mainFile)])
+        self.notify.info('Syncing build files...')
+        stats = {'unchanged': 0, 'linked': 0, 'copied': 0, 'removed': 0, 'bytes': 0}
+        for sourceDir in self.sourceDirs:
+            filepath = os.path.join(self.baseDir, sourceDir)
+            destDir = os.path.join(self.workingDir, sourceDir)
+            if not os.path.exists(filepath):
+                if os.path.exists(destDir):
+                    shutil.rmtree(destDir)
+
+                continue
+
+            for key, count in self.syncTree(filepath, destDir, allowLink=True).items():
+                stats[key] += count
+
+        if os.path.exists(self.mainFile):
+            os.makedirs(self.workingDir, exist_ok=True)
+            status = self.copyEntryPoint(allowLink=True)
+            stats[status] += 1
+            if status != 'unchanged':
+                stats['bytes'] += os.path.getsize(os.path.join(self.workingDir, os.path.basename(self.mainFile)))
+
+        self.notify.info('Build files synced successfully: %(unchanged)d unchanged, %(linked)d linked, %(copied)d copied, %(removed)d removed.' % stats)
+        return stats['bytes']
 
     def encryptData(self, data):
         key = Fernet.generate_key()
@@ -95,14 +1323,69 @@ class FunnyFarmCompilerBase:
 
         self.notify.info('Config data generated successfully.')
 
-    def buildGame(self):
-        self.notify.info('Building the game...')
+    def getCompilerCommand(self):
+        if self.compilerCommand:
+            return list(self.compilerCommand)
+
         try:
             import nuitka
         except:
             raise ModuleNotFoundError('Nuitka was not found! Please install Nuitka via pip.')
 
-        returnCode = subprocess.check_call([sys.executable, '-OO', '-m', 'nuitka', '--standalone', '--file-reference-choice=frozen', '--show-progress', '--show-scons', '--follow-imports', '--python-flag=-S,-OO', '%s' % os.path.basename(self.mainFile)], cwd=self.workingDir)
+        return [sys.executable, '-OO', '-m', 'nuitka']
+
+    def getCompilerVersion(self):
+        if self.compilerVersion is None:
+            self.compilerVersion = subprocess.check_output(self.getCompilerCommand() + ['--version'], cwd=self.rootDir).strip()
+
+        return self.compilerVersion
+
+    def getGameFingerprint(self):
+        # Covers everything that goes into the compiled game: the sources, the main
+        # file, the config and version baked into gamedata.py, and the compiler itself.
+        fingerprint = hashlib.md5()
+        compilerCommand = self.getCompilerCommand()
+        fingerprint.update(self.getCompilerVersion() + b'\n')
+        fingerprint.update(('%r\n%r\n%s\n' % (compilerCommand, self.compilerFlags, self.version)).encode('utf-8'))
+        for sourceDir in self.sourceDirs:
+            filepath = os.path.join(self.baseDir, sourceDir)
+            if os.path.exists(filepath):
+                fingerprint.update(('%s\0%s\n' % (sourceDir, self.getTreeHash(filepath))).encode('utf-8'))
+
+        # The main file as it is compiled, so turning profiling on or off rebuilds the game.
+        if os.path.exists(self.mainFile):
+            source = self.getEntryPointSource().encode('utf-8')
+            fingerprint.update(('%s\0%s\n' % (os.path.basename(self.mainFile), hashlib.md5(source).hexdigest())).encode('utf-8'))
+
+        if self.configFile:
+            filepath = os.path.join(self.baseDir, self.configFile)
+            if os.path.exists(filepath):
+                fingerprint.update(('%s\0%s\n' % (os.path.basename(filepath), self.getFileHash(filepath))).encode('utf-8'))
+
+        return fingerprint.hexdigest()
+
+    def getGameFingerprintPath(self):
+        return os.path.join(self.workingDir, '%s.fingerprint' % self.getMainFileName())
+
+    def readGameFingerprint(self):
+        # The fingerprint is only meaningful if the build it describes is still there.
+        fingerprintPath = self.getGameFingerprintPath()
+        if not os.path.exists(os.path.join(self.workingDir, '%s.dist' % self.getMainFileName())):
+            return None
+
+        if not os.path.exists(fingerprintPath):
+            return None
+
+        with open(fingerprintPath, 'r') as f:
+            return f.read().strip()
+
+    def writeGameFingerprint(self, fingerprint):
+        with open(self.getGameFingerprintPath(), 'w') as f:
+            f.write(fingerprint)
+
+    def buildGame(self):
+        self.notify.info('Building the game...')
+        returnCode = subprocess.check_call(self.getCompilerCommand() + self.compilerFlags + ['%s' % os.path.basename(self.mainFile)], cwd=self.workingDir)
         if returnCode == 0:
             self.notify.info('Build finished successfully!')
 
@@ -110,25 +1393,530 @@ class FunnyFarmCompilerBase:
         # This is entirely platform dependent and must be overriden by subclass.
         raise NotImplementedError('copyToBuiltDir')
 
-    def buildResources(self):
-        if not os.path.exists(self.panda3dDevDir):
+    def getTreeHash(self, treeDir):
+        # Hashes the relative path, size and contents of every file in the tree,
+        # so any added, removed, renamed or modified file changes the tree hash.
+        treeHash = hashlib.md5()
+        filepaths = []
+        for dirpath, dirnames, filenames in os.walk(treeDir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                filepaths.append(os.path.join(dirpath, filename))
+
+        if self.treeHashCache:
+            digests = self.getHashExecutor().map(self.getTreeFileHash, filepaths)
+        else:
+            digests = self.hashFiles(filepaths)
+
+        for filepath, digest in zip(filepaths, digests):
+            relpath = os.path.relpath(filepath, treeDir).replace(os.sep, '/')
+            entry = '%s\0%d\0%s\n' % (relpath, os.path.getsize(filepath), digest)
+            treeHash.update(entry.encode('utf-8'))
+
+        return treeHash.hexdigest()
+
+    def getTreeFileHash(self, filepath):
+        entry = self.treeHashCache.lookup(filepath, filepath, self.getFileHash)
+        if entry:
+            return entry['hash']
+
+        digest = self.getFileHash(filepath)
+        self.treeHashCache.store(filepath, filepath, digest)
+        return digest
+
+    def getResourceIndexPath(self):
+        return os.path.join(self.builtDir, 'resources-index.json')
+
+    def loadResourceIndex(self):
+        indexPath = self.getResourceIndexPath()
+        if not os.path.exists(indexPath):
+            return {}
+
+        try:
+            with open(indexPath, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            self.notify.warning('Resource index is unreadable, all phases will be rebuilt.')
+            return {}
+
+        if not isinstance(index, dict):
+            return {}
+
+        return index
+
+    def saveResourceIndex(self, index):
+        indexPath = self.getResourceIndexPath()
+        with open(indexPath + '.tmp', 'w') as f:
+            f.write(json.dumps(index, indent=4, sort_keys=True))
+
+        os.replace(indexPath + '.tmp', indexPath)
+
+    def getTreeSize(self, treeDir):
+        treeSize = 0
+        for dirpath, dirnames, filenames in os.walk(treeDir):
+            for filename in filenames:
+                treeSize += os.path.getsize(os.path.join(dirpath, filename))
+
+        return treeSize
+
+    def getPackingOptions(self):
+        # Anything that changes how a phase is packed, so changing it repacks the phase.
+        if self.packer == 'multify':
+            return 'multify'
+
+        return 'native:%d' % self.multifileCompressionLevel
+
+    def getSubfileCompressionLevel(self, name):
+        if os.path.splitext(name)[1].lower() in PRECOMPRESSED_EXTENSIONS:
+            return 0
+
+        return self.multifileCompressionLevel
+
+    def getPhaseSubfiles(self, resourcesDir, phase, redirects=None):
+        # Lists the subfiles in the same order multify adds them: sorted, with
+        # each directory's contents added where the directory is encountered.
+        # Files that were deduplicated into another phase are left out.
+        subfiles = []
+        redirects = redirects or {}
+
+        def addDirectory(directory):
+            for item in sorted(os.listdir(os.path.join(resourcesDir, directory))):
+                name = directory + '/' + item
+                sourcePath = os.path.join(resourcesDir, name)
+                if os.path.isdir(sourcePath):
+                    addDirectory(name)
+                elif name not in redirects:
+                    subfiles.append((name, sourcePath, self.getSubfileCompressionLevel(name)))
+
+        addDirectory(phase)
+        if redirects:
+            subfiles.append((phase + '/' + DEDUPE_REDIRECTS_NAME, self.writeDedupeRedirects(phase, redirects), self.multifileCompressionLevel))
+
+        return subfiles
+
+    def packPhase(self, phase, resourcesDir, filepath, previousFilepath=None, redirects=None, previousLevel=None):
+        if self.packer == 'multify':
+            # Pack next to the destination and swap it in, so a failed build
+            # never leaves a partial multifile behind.
+            tempFilepath = filepath + '.tmp'
+            if os.path.exists(tempFilepath):
+                os.remove(tempFilepath)
+
+            subprocess.check_call([os.path.join(self.panda3dDevDir, 'bin', 'multify'), '-c', '-f', tempFilepath, phase], cwd=resourcesDir)
+            os.replace(tempFilepath, filepath)
+            return
+
+        # Packing in-process lets us reuse the data of subfiles that didn't change
+        # from the previous multifile instead of reading and compressing them again.
+        subfiles = self.getPhaseSubfiles(resourcesDir, phase, redirects)
+        reused = FunnyFarmMultifile(filepath).write(subfiles, previousFilepath, previousLevel)
+        if reused:
+            self.notify.info('%s: reused %d of %d subfiles.' % (phase, reused, len(subfiles)))
+
+    def buildPhase(self, phase, resourcesDir, destDir, index, redirects=None):
+        filepath = os.path.join(destDir, phase + '.mf')
+        phaseDir = os.path.join(resourcesDir, phase)
+        with self.metrics.measure('hashTree', phase) as sizes:
+            key = '%s\0%s' % (self.getTreeHash(phaseDir), self.getPackingOptions())
+            if redirects:
+                # Which files are deduplicated also depends on the other phases.
+                key += '\0' + json.dumps(redirects, sort_keys=True)
+
+            treeHash = hashlib.md5(key.encode('utf-8')).hexdigest()
+            sizes['bytesRead'] = self.getTreeSize(phaseDir)
+
+        # The index records how each phase was packed, so subfiles are only reused
+        # if they were compressed at the current level. Entries from before that
+        # are just the tree hash.
+        previous = index.get(phase)
+        if not isinstance(previous, dict):
+            previous = {'hash': previous}
+
+        entry = {'hash': treeHash, 'packer': self.packer, 'level': self.multifileCompressionLevel}
+        if not self.forceRebuild and previous.get('hash') == treeHash and os.path.exists(filepath):
+            return entry, 'unchanged'
+
+        previousFilepath = filepath if not self.forceRebuild and os.path.exists(filepath) else None
+        previousLevel = previous.get('level') if previous.get('packer') == 'native' else None
+        if not self.resourceStore:
+            with self.metrics.measure(self.packer, phase) as sizes:
+                self.packPhase(phase, resourcesDir, filepath, previousFilepath, redirects, previousLevel)
+                sizes['bytesRead'] = self.getTreeSize(phaseDir)
+                sizes['bytesWritten'] = os.path.getsize(filepath)
+
+            return entry, 'built'
+
+        # With a shared store the phase is always packed into the store, and the
+        # built directory only gets a link to it, so targets sharing the store
+        # pack each phase once.
+        status = 'linked'
+        storePath = self.resourceStore.getPath(phase, treeHash)
+        if not self.resourceStore.contains(phase, treeHash, self.forceRebuild):
+            os.makedirs(os.path.dirname(storePath), exist_ok=True)
+            with self.metrics.measure(self.packer, phase) as sizes:
+                self.packPhase(phase, resourcesDir, storePath, previousFilepath, redirects, previousLevel)
+                sizes['bytesRead'] = self.getTreeSize(phaseDir)
+                sizes['bytesWritten'] = os.path.getsize(storePath)
+
+            self.resourceStore.add(phase, treeHash)
+            status = 'built'
+
+        with self.metrics.measure('linkPhase', phase):
+            self.linkFile(storePath, filepath)
+
+        return entry, status
+
+    def getPhaseLoadOrder(self, phases):
+        # The launch phases are loaded first, then the others in phase order.
+        def getKey(phase):
+            phaseNumber = self.getPhaseNumber(phase)
+            return phase not in self.launchPhases, phaseNumber if phaseNumber is not None else float('inf'), phase
+
+        return sorted(phases, key=getKey)
+
+    def hashResourceFiles(self, resourcesDir, phases):
+        # Returns the digest and size of every file in the phases. Digests are
+        # kept in a persisted index, so only changed files are read again.
+        index = self.getWorkingHashCache('resources-hashcache.json')
+        relpaths = []
+        for phase in phases:
+            for dirpath, dirnames, filenames in os.walk(os.path.join(resourcesDir, phase)):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    relpaths.append(os.path.relpath(os.path.join(dirpath, filename), resourcesDir).replace(os.sep, '/'))
+
+        def hashFile(relpath):
+            filepath = os.path.join(resourcesDir, *relpath.split('/'))
+            entry = None if self.forceRebuild else index.lookup(relpath, filepath, self.getFileHash)
+            if entry:
+                return entry['hash'], entry['size']
+
+            digest = self.getFileHash(filepath)
+            index.store(relpath, filepath, digest)
+            return digest, os.path.getsize(filepath)
+
+        try:
+            with self.metrics.measure('hashResources') as sizes:
+                files = OrderedDict(zip(relpaths, self.getHashExecutor().map(hashFile, relpaths)))
+                sizes['bytesRead'] = sum(size for digest, size in files.values())
+        finally:
+            # Files that are gone are dropped from the index.
+            existing = set(relpaths)
+            index.entries = {relpath: entry for relpath, entry in index.entries.items() if relpath in existing}
+            index.save()
+
+        index.report()
+        return files
+
+    def findDuplicateAssets(self, files):
+        # Returns (digest, size, relpaths) for every set of files with the same contents.
+        groups = OrderedDict()
+        for relpath, (digest, size) in files.items():
+            groups.setdefault((digest, size), []).append(relpath)
+
+        return [(digest, size, relpaths) for (digest, size), relpaths in groups.items() if len(relpaths) > 1]
+
+    def analyzeDuplicates(self):
+        resourcesDir = os.path.join(self.baseDir, 'resources')
+        phases = self.getPhaseLoadOrder(phase for phase in os.listdir(resourcesDir) if phase.startswith('phase_'))
+        self.notify.info('Scanning %d phases for duplicate assets using %d job(s)...' % (len(phases), self.jobs))
+        files = self.hashResourceFiles(resourcesDir, phases)
+        duplicates = self.findDuplicateAssets(files)
+
+        # Bytes shipped more than once, in total and between every two phases
+        # sharing a file. A file copied within one phase is only counted in the total.
+        groups = []
+        pairs = {}
+        for digest, size, relpaths in duplicates:
+            groupPhases = self.getPhaseLoadOrder(set(relpath.split('/')[0] for relpath in relpaths))
+            for i, phase in enumerate(groupPhases):
+                for otherPhase in groupPhases[i + 1:]:
+                    pairs[(phase, otherPhase)] = pairs.get((phase, otherPhase), 0) + size
+
+            group = OrderedDict()
+            group['hash'] = digest
+            group['size'] = size
+            group['wasted'] = size * (len(relpaths) - 1)
+            group['files'] = relpaths
+            groups.append(group)
+
+        groups.sort(key=lambda group: group['wasted'], reverse=True)
+        pairs = sorted(pairs.items(), key=lambda pair: pair[1], reverse=True)
+        totalSize = sum(size for digest, size in files.values())
+        wasted = sum(group['wasted'] for group in groups)
+        self.notify.info('Found %d duplicate groups in %d files: %.2f MB of %.2f MB is duplicated (%.1f%%).' % (
+            len(groups), len(files), wasted / 1048576.0, totalSize / 1048576.0, 100.0 * wasted / totalSize if totalSize else 0.0))
+
+        for (phase, otherPhase), size in pairs[:DUPLICATE_REPORT_SIZE]:
+            self.notify.info('  %s and %s share %.2f MB' % (phase, otherPhase, size / 1048576.0))
+
+        for group in groups[:DUPLICATE_REPORT_SIZE]:
+            self.notify.info('  %.2f MB wasted by %d copies of %s' % (group['wasted'] / 1048576.0, len(group['files']), ', '.join(group['files'])))
+
+        report = OrderedDict()
+        report['files'] = len(files)
+        report['size'] = totalSize
+        report['wasted'] = wasted
+        report['phasePairs'] = [OrderedDict([('phases', list(phasePair)), ('wasted', size)]) for phasePair, size in pairs]
+        report['groups'] = groups
+        reportPath = os.path.join(self.workingDir, 'duplicates.json')
+        with open(reportPath, 'w') as f:
+            f.write(json.dumps(report, indent=4))
+
+        self.notify.info('Duplicate report written to %s.' % reportPath)
+        return report
+
+    def getDedupeRedirects(self, resourcesDir, phases):
+        # Every file that also exists in a phase loaded earlier is redirected
+        # to the first copy in the earliest of them, and left out of its phase.
+        order = {phase: i for i, phase in enumerate(self.getPhaseLoadOrder(phases))}
+        redirects = {}
+        for digest, size, relpaths in self.findDuplicateAssets(self.hashResourceFiles(resourcesDir, phases)):
+            relpaths = sorted(relpaths, key=lambda relpath: (order[relpath.split('/')[0]], relpath))
+            keptPhase = relpaths[0].split('/')[0]
+            for relpath in relpaths[1:]:
+                if relpath.split('/')[0] != keptPhase:
+                    redirects[relpath] = relpaths[0]
+
+        return redirects
+
+    def writeDedupeRedirects(self, phase, redirects):
+        # The file is only rewritten when it changes, so its subfile can be reused.
+        filepath = os.path.join(self.workingDir, 'dedupe', phase + '.json')
+        data = json.dumps(OrderedDict(sorted(redirects.items())), indent=4)
+        if os.path.exists(filepath):
+            with open(filepath, 'r') as f:
+                if f.read() == data:
+                    return filepath
+
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath + '.tmp', 'w') as f:
+            f.write(data)
+
+        os.replace(filepath + '.tmp', filepath)
+        return filepath
+
+    def getConverters(self):
+        # egg2bam ships with the Panda3D SDK, configured converters take precedence.
+        converters = OrderedDict()
+        converters['.egg'] = ('.bam', [os.path.join(self.panda3dDevDir, 'bin', 'egg2bam'), '-o', '{output}', '{input}'])
+        converters.update(self.converters)
+        return converters
+
+    def getConversionCachePath(self, key, targetExtension):
+        return os.path.join(self.rootDir, 'builds', 'conversion-cache', key[:2], key + targetExtension)
+
+    def convertAsset(self, sourcePath, digest, targetExtension, command):
+        # Conversions are cached by the contents of the asset and the command
+        # converting it, so an asset is only ever converted once, whatever its
+        # path, version or target. Returns the path of the converted file.
+        key = hashlib.md5(('%s\0%s\0%s' % (digest, targetExtension, '\0'.join(command))).encode('utf-8')).hexdigest()
+        cachePath = self.getConversionCachePath(key, targetExtension)
+        if os.path.exists(cachePath):
+            return cachePath, False
+
+        os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+        tempPath = os.path.join(os.path.dirname(cachePath), '%s.%d.tmp%s' % (key, threading.get_ident(), targetExtension))
+        try:
+            subprocess.check_call([arg.replace('{input}', sourcePath).replace('{output}', tempPath) for arg in command])
+            if not os.path.exists(tempPath):
+                raise RuntimeError('%s did not write %s' % (command[0], tempPath))
+
+            os.replace(tempPath, cachePath)
+        finally:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+
+        return cachePath, True
+
+    def preprocessResources(self, resourcesDir):
+        # Builds a staging copy of the resources in which assets that have a
+        # converter are replaced by their converted file, and returns it. Other
+        # files are linked into the staging directory as they are.
+        self.notify.info('Preprocessing the resources...')
+        stagingDir = os.path.join(self.workingDir, 'preprocessed')
+        converters = self.getConverters()
+        hashCache = self.getWorkingHashCache('preprocess-hashcache.json')
+
+        phases = sorted(phase for phase in os.listdir(resourcesDir) if phase.startswith('phase_'))
+        sourceFiles = OrderedDict()
+        for phase in phases:
+            for dirpath, dirnames, filenames in os.walk(os.path.join(resourcesDir, phase)):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    sourcePath = os.path.join(dirpath, filename)
+                    sourceFiles[os.path.relpath(sourcePath, resourcesDir).replace(os.sep, '/')] = sourcePath
+
+        # Maps each file of the staging directory to the asset it comes from,
+        # and the converter producing it if it isn't simply the asset itself.
+        stagedFiles = OrderedDict()
+        for relpath, sourcePath in sourceFiles.items():
+            base, extension = os.path.splitext(relpath)
+            converter = converters.get(extension.lower())
+            if converter and base + converter[0] != relpath and base + converter[0] in sourceFiles:
+                self.notify.warning('%s already exists, not converting %s.' % (base + converter[0], relpath))
+                converter = None
+
+            if converter:
+                stagedFiles[base + converter[0]] = (relpath, converter)
+            else:
+                stagedFiles[relpath] = (relpath, None)
+
+        # Identical assets are converted one at a time, so only the first of
+        # them runs the converter and the others find it in the cache.
+        digestLocks = {}
+        digestLocksLock = threading.Lock()
+
+        def convert(relpath, converter):
+            sourcePath = sourceFiles[relpath]
+            entry = None if self.forceRebuild else hashCache.lookup(relpath, sourcePath, self.getFileHash)
+            digest = entry['hash'] if entry else self.getFileHash(sourcePath)
+            hashCache.store(relpath, sourcePath, digest)
+            with digestLocksLock:
+                digestLock = digestLocks.setdefault(digest, threading.Lock())
+
+            with digestLock:
+                return self.convertAsset(sourcePath, digest, converter[0], converter[1])
+
+        # Converters are separate processes, so assets are converted in parallel.
+        convertedFiles = {}
+        convertedPaths = set()
+        converted = bytesRead = bytesWritten = 0
+        try:
+            with self.metrics.measure('convertAssets') as sizes:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                    futures = {executor.submit(convert, relpath, converter): stagedPath for stagedPath, (relpath, converter) in stagedFiles.items() if converter}
+                    for future in concurrent.futures.as_completed(futures):
+                        stagedPath = futures[future]
+                        try:
+                            convertedFiles[stagedPath], didConvert = future.result()
+                        except Exception as e:
+                            for pending in futures:
+                                pending.cancel()
+
+                            self.notify.error('Failed to convert %s! (%s)' % (stagedFiles[stagedPath][0], e))
+
+                        if didConvert:
+                            convertedPaths.add(stagedPath)
+                            converted += 1
+                            bytesRead += os.path.getsize(sourceFiles[stagedFiles[stagedPath][0]])
+                            bytesWritten += os.path.getsize(convertedFiles[stagedPath])
+
+                sizes['bytesRead'] = bytesRead
+                sizes['bytesWritten'] = bytesWritten
+        finally:
+            hashCache.save()
+
+        self.notify.info('Converted %d asset(s), %d taken from the conversion cache.' % (converted, len(convertedFiles) - converted))
+
+        with self.metrics.measure('stageResources'):
+            for phase in phases:
+                os.makedirs(os.path.join(stagingDir, phase), exist_ok=True)
+
+            for stagedPath, (relpath, converter) in stagedFiles.items():
+                sourcePath = convertedFiles.get(stagedPath, sourceFiles[relpath])
+                self.syncFile(sourcePath, os.path.join(stagingDir, stagedPath), allowLink=True)
+
+            for dirpath, dirnames, filenames in os.walk(stagingDir, topdown=False):
+                for filename in filenames:
+                    filepath = os.path.join(dirpath, filename)
+                    if os.path.relpath(filepath, stagingDir).replace(os.sep, '/') not in stagedFiles:
+                        os.remove(filepath)
+
+                if dirpath != stagingDir and not os.listdir(dirpath) and os.path.relpath(dirpath, stagingDir) not in phases:
+                    os.rmdir(dirpath)
+
+        # Report how much converting saved in every phase.
+        report = OrderedDict()
+        for phase in phases:
+            sourceSize = convertedSize = count = phaseConverted = 0
+            for stagedPath, filepath in convertedFiles.items():
+                if stagedPath.startswith(phase + '/'):
+                    sourceSize += os.path.getsize(sourceFiles[stagedFiles[stagedPath][0]])
+                    convertedSize += os.path.getsize(filepath)
+                    count += 1
+                    phaseConverted += stagedPath in convertedPaths
+
+            if count:
+                saved = sourceSize - convertedSize
+                self.notify.info('%s: %d asset(s), %.2f MB -> %.2f MB (saved %.2f MB, %.1f%%)' % (
+                    phase, count, sourceSize / 1048576.0, convertedSize / 1048576.0, saved / 1048576.0,
+                    100.0 * saved / sourceSize if sourceSize else 0.0))
+                report[phase] = OrderedDict([('assets', count), ('converted', phaseConverted), ('cached', count - phaseConverted),
+                                             ('sourceSize', sourceSize), ('convertedSize', convertedSize), ('saved', saved)])
+
+        with open(os.path.join(self.workingDir, 'preprocess-report.json'), 'w') as f:
+            f.write(json.dumps(report, indent=4))
+
+        return stagingDir
+
+    def buildResources(self, phases=None):
+        # Only the given phases are built if there are any, the others are left as they are.
+        if self.packer == 'multify' and not os.path.exists(self.panda3dDevDir):
             self.notify.error('Panda3D development SDK not found! Unable to build resources.')
 
+        if self.dedupeResources and self.packer != 'native':
+            self.notify.error('Deduplicating resources requires the native packer!')
+
         self.notify.info('Building the resources...')
         destDir = os.path.join(self.builtDir, 'resources')
         if not os.path.exists(destDir):
             os.makedirs(destDir)
 
         resourcesDir = os.path.join(self.baseDir, 'resources')
-        for phase in os.listdir(resourcesDir):
-            if not phase.startswith('phase_'):
-                continue
-
-            filename = phase + '.mf'
-            filepath = os.path.join(destDir, filename)
-            returnCode = subprocess.check_call([os.path.join(self.panda3dDevDir, 'bin', 'multify'), '-c', '-f', filepath, phase], cwd=resourcesDir)
-            if returnCode == 0:
-                self.notify.info('%s built successfully!' % phase)
+        if self.preprocess:
+            # Phases are packed from the converted assets instead of the sources.
+            resourcesDir = self.preprocessResources(resourcesDir)
+
+        allPhases = sorted(phase for phase in os.listdir(resourcesDir) if phase.startswith('phase_'))
+        phases = allPhases if phases is None else [phase for phase in allPhases if phase in phases]
+        redirects = {}
+        if self.dedupeResources:
+            redirects = self.getDedupeRedirects(resourcesDir, allPhases)
+            saved = sum(os.path.getsize(os.path.join(resourcesDir, *relpath.split('/'))) for relpath in redirects)
+            self.notify.info('Deduplicating %d files (%.2f MB) into earlier phases.' % (len(redirects), saved / 1048576.0))
+            self.notify.warning('Deduplicated files are only found by games that apply the %s of each phase!' % DEDUPE_REDIRECTS_NAME)
+
+        self.notify.info('Building %d phases using %d job(s)...' % (len(phases), self.jobs))
+
+        # Phases whose file tree matches the last successful build are left alone.
+        # A stale entry can never match a changed tree, so it is safe to carry the
+        # old entries over until the phase has been rebuilt, unless we are forced.
+        oldIndex = {} if self.forceRebuild else self.loadResourceIndex()
+        index = {phase: oldIndex[phase] for phase in allPhases if phase in oldIndex}
+
+        # Each phase is packed into its own multifile, so they can all be
+        # built at the same time. With a single job this is the serial build.
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                futures = {}
+                for phase in phases:
+                    phaseRedirects = {relpath: keptRelpath for relpath, keptRelpath in redirects.items() if relpath.startswith(phase + '/')}
+                    futures[executor.submit(self.buildPhase, phase, resourcesDir, destDir, oldIndex, phaseRedirects)] = phase
+
+                for future in concurrent.futures.as_completed(futures):
+                    phase = futures[future]
+                    try:
+                        entry, status = future.result()
+                    except Exception as e:
+                        # Stop on the first failure; phases that haven't started yet are cancelled
+                        # and the ones already running are waited on before we bail out.
+                        for pending in futures:
+                            pending.cancel()
+
+                        # The multifile may have been partially written, so never trust it again.
+                        index.pop(phase, None)
+                        self.notify.error('Failed to build %s! (%s)' % (phase, e))
+
+                    index[phase] = entry
+                    if status == 'built':
+                        self.notify.info('%s built successfully!' % phase)
+                    elif status == 'linked':
+                        self.notify.info('%s linked from the resource store.' % phase)
+                    else:
+                        self.notify.info('%s is up to date.' % phase)
+        finally:
+            self.saveResourceIndex(index)
 
         self.notify.info('All resources built successfully!')
 
@@ -136,27 +1924,159 @@ class FunnyFarmCompilerBase:
         # This is entirely platform dependent and must be overriden by subclass.
         raise NotImplementedError('getDistributables')
 
-    def getFileMD5Hash(self, filepath):
-        md5 = hashlib.md5()
-        readBlock = lambda: f.read(128 * md5.block_size)
-        with open(filepath, 'rb') as f:
-            for chunk in iter(readBlock, b''):
-                md5.update(chunk)
-
-        return md5.hexdigest()
-
-    def writeManifest(self):
+    def getReadBuffer(self):
+        # Every thread reads into its own buffer, which is reused for every file.
+        buffer = getattr(self.readBuffers, 'buffer', None)
+        if buffer is None:
+            buffer = self.readBuffers.buffer = memoryview(bytearray(READ_CHUNK_SIZE))
+
+        return buffer
+
+    def getFileHash(self, filepath, algorithm='md5'):
+        # Files are read straight into the thread's buffer, so hashing doesn't
+        # allocate anything per chunk. hashlib releases the GIL while hashing.
+        fileHash = hashlib.new(algorithm)
+        buffer = self.getReadBuffer()
+        with open(filepath, 'rb', buffering=0) as f:
+            for length in iter(lambda: f.readinto(buffer), 0):
+                fileHash.update(buffer[:length])
+
+        return fileHash.hexdigest()
+
+    def getManifestFileHash(self, filepath):
+        return self.getFileHash(filepath, self.hashAlgorithm)
+
+    def getHashExecutor(self):
+        # One pool hashes files for the whole build, so callers that already
+        # run in parallel (like the phases) don't each start their own.
+        with self.hashExecutorLock:
+            if not self.hashExecutor:
+                self.hashExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+
+            return self.hashExecutor
+
+    def hashFiles(self, filepaths, algorithm='md5'):
+        # Returns the digests of the files, in the same order.
+        return list(self.getHashExecutor().map(lambda filepath: self.getFileHash(filepath, algorithm), filepaths))
+
+    def getWorkingHashCache(self, filename):
+        # Hash caches of the working directory are loaded once, and then kept
+        # in memory for every later build of this process.
+        if filename not in self.hashCaches:
+            hashCache = FunnyFarmHashCache(os.path.join(self.workingDir, filename), self.verifyHashCache)
+            hashCache.load()
+            self.hashCaches[filename] = hashCache
+
+        return self.hashCaches[filename]
+
+    def getHashCache(self):
+        # The cache lives next to the built directory, so it survives across runs.
+        if not self.hashCache:
+            self.hashCache = FunnyFarmHashCache(os.path.join(self.workingDir, 'hashcache.json'), self.verifyHashCache, self.hashAlgorithm)
+            self.hashCache.load()
+
+        return self.hashCache
+
+    def getCachedFileHash(self, filepath):
+        sourcePath = os.path.join(self.builtDir, filepath)
+        hashCache = self.getHashCache()
+        entry = None if self.forceRebuild else hashCache.lookup(filepath, sourcePath, self.getManifestFileHash)
+        if entry:
+            return entry['hash']
+
+        with self.metrics.measure('hash', filepath) as sizes:
+            digest = self.getManifestFileHash(sourcePath)
+            sizes['bytesRead'] = os.path.getsize(sourcePath)
+
+        hashCache.store(filepath, sourcePath, digest)
+        return digest
+
+    def getPhaseNumber(self, phase):
+        try:
+            return float(phase[len('phase_'):])
+        except ValueError:
+            return None
+
+    def getDownloadPriority(self, filepath):
+        # Returns the download group of a distributable and its priority, lower
+        # priorities are downloaded first. Subclasses may override this to
+        # change what the game needs to launch on their platform.
+        phase = os.path.splitext(os.path.basename(filepath))[0]
+        if not filepath.startswith('resources/'):
+            return 'launch', 0
+
+        if phase in self.launchPhases:
+            return 'launch', 1 + self.launchPhases.index(phase)
+
+        # Background phases are downloaded in the order the game reaches them,
+        # anything that isn't numbered goes last.
+        phaseNumber = self.getPhaseNumber(phase)
+        return 'background', 1 + len(self.launchPhases) + (int(phaseNumber * 10) if phaseNumber is not None else 10000)
+
+    def getManifestOrder(self):
+        return sorted(self.getDistributables(), key=lambda filepath: self.getDownloadPriority(filepath)[1])
+
+    def writeManifest(self, results=None, patches=None):
+        # If the distributables were already hashed while compressing them,
+        # the results are passed in and nothing needs to be read again.
         self.notify.info('Writing patch manifest...')
         distDir = os.path.join(self.builtDir, 'dist')
-        os.chdir(self.builtDir)
         manifest = OrderedDict()
+        if self.manifestFormat == 'chunked':
+            # Chunked manifests list every file as the chunks it is made of,
+            # which are kept in a content-addressed store under dist/chunks.
+            if results is None:
+                results = self.chunkFiles()
+
+            manifest['format'] = 'chunked'
+            manifest['chunk-store'] = 'chunks'
+        else:
+            # Compressed files and patches are published to a content-addressed
+            # store, so republishing never changes what an older manifest refers to.
+            manifest['object-store'] = 'objects'
+
+        manifest['hash-algorithm'] = self.hashAlgorithm
+        if results is None:
+            # Nothing was hashed yet, so hash all of the files at once.
+            distributables = self.getDistributables()
+            hashes = dict(zip(distributables, self.getHashExecutor().map(self.getCachedFileHash, distributables)))
+
+        # Files are listed in download order, and each one carries its group and
+        # priority, so the launcher can start the game once the launch group is in.
+        manifest['groups'] = OrderedDict()
         manifest['files'] = OrderedDict()
         self.notify.info('Writing files to patch manifest...')
-        for filepath in self.getDistributables():
+        for filepath in self.getManifestOrder():
             self.notify.info('Adding %s...' % filepath)
+            group, priority = self.getDownloadPriority(filepath)
             manifest['files'][filepath] = OrderedDict()
             manifest['files'][filepath]['path'] = os.path.dirname(filepath)
-            manifest['files'][filepath]['hash'] = self.getFileMD5Hash(filepath)
+            manifest['files'][filepath]['group'] = group
+            manifest['files'][filepath]['priority'] = priority
+            if results is not None:
+                result = results[filepath]
+                manifest['files'][filepath]['hash'] = result['hash']
+                manifest['files'][filepath]['size'] = result['size']
+                if self.manifestFormat == 'chunked':
+                    manifest['files'][filepath]['codec'] = result['codec']
+                    manifest['files'][filepath]['compressedSize'] = sum(os.path.getsize(self.getChunkPath(digest, result['codec'])) for digest, length in result['chunks'])
+                    manifest['files'][filepath]['chunks'] = result['chunks']
+                else:
+                    manifest['files'][filepath]['codec'] = result['codec']
+                    manifest['files'][filepath]['compressedSize'] = result['compressedSize']
+                    manifest['files'][filepath]['compressedHash'] = result['compressedHash']
+            else:
+                manifest['files'][filepath]['hash'] = hashes[filepath]
+                manifest['files'][filepath]['size'] = os.path.getsize(os.path.join(self.builtDir, filepath))
+
+            groupTotals = manifest['groups'].setdefault(group, OrderedDict([('files', 0), ('size', 0)]))
+            groupTotals['files'] += 1
+            groupTotals['size'] += manifest['files'][filepath]['size']
+            if 'compressedSize' in manifest['files'][filepath]:
+                groupTotals['compressedSize'] = groupTotals.get('compressedSize', 0) + manifest['files'][filepath]['compressedSize']
+
+            if patches and filepath in patches:
+                manifest['files'][filepath]['patch'] = patches[filepath]
 
         self.notify.info('Files written to patch manifest successfully.')
 
@@ -175,34 +2095,440 @@ class FunnyFarmCompilerBase:
             f.write(json.dumps(manifest, indent=4))
             f.close()
 
-        os.chdir(self.rootDir)
+        if results is None:
+            self.hashCache.save()
+            self.hashCache.report()
+
         self.notify.info('Successfully wrote patch manifest.')
 
-    def compressFile(self, filepath):
-        distDir = os.path.join(self.builtDir, 'dist')
-        with open(filepath, 'rb') as f:
-            data = f.read()
+    def compressData(self, codecName, data):
+        compressor = CODECS[codecName]['compressor']()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompressChunk(self, decompressor, codecName, chunk):
+        # Yields the decompressed data in pieces of at most READ_CHUNK_SIZE bytes
+        # where the codec allows it, so highly compressed data can't blow up memory.
+        outputLimit = CODECS[codecName]['outputLimit']
+        if outputLimit == 'needs_input':
+            yield decompressor.decompress(chunk, READ_CHUNK_SIZE)
+            while not decompressor.eof and not decompressor.needs_input:
+                yield decompressor.decompress(b'', READ_CHUNK_SIZE)
+        elif outputLimit == 'unconsumed_tail':
+            yield decompressor.decompress(chunk, READ_CHUNK_SIZE)
+            while not decompressor.eof and decompressor.unconsumed_tail:
+                yield decompressor.decompress(decompressor.unconsumed_tail, READ_CHUNK_SIZE)
+        else:
+            yield decompressor.decompress(chunk)
+
+    def iterDecompressedChunks(self, f, codecName, rawHash=None):
+        # Streams the decompressed contents of a file, following on to the next
+        # stream whenever one ends, since large files are compressed in blocks.
+        # The compressed data is fed to rawHash as it is read, if given.
+        codec = CODECS[codecName]
+        decompressor = None
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            if rawHash is not None:
+                rawHash.update(chunk)
+
+            while chunk:
+                if decompressor is None:
+                    decompressor = codec['decompressor']()
+
+                yield from self.decompressChunk(decompressor, codecName, chunk)
+                if decompressor.eof:
+                    chunk = decompressor.unused_data
+                    decompressor = None
+                else:
+                    chunk = b''
+
+        if decompressor is not None:
+            raise EOFError('%s data ended before the end-of-stream marker' % codecName)
+
+    def selectCodec(self, filepath, sourcePath, size):
+        # Trial compresses a few slices spread across the file with every codec,
+        # and picks the smallest result among the codecs that decompress at least
+        # as fast as the budget allows. Ties go to the codec listed first.
+        sample = b''
+        with open(sourcePath, 'rb') as f:
+            if size <= CODEC_SAMPLE_SIZE:
+                sample = f.read()
+            else:
+                sliceSize = CODEC_SAMPLE_SIZE // CODEC_SAMPLE_SLICES
+                for i in range(CODEC_SAMPLE_SLICES):
+                    f.seek((size - sliceSize) * i // (CODEC_SAMPLE_SLICES - 1))
+                    sample += f.read(sliceSize)
+
+        if not sample:
+            return 'bz2'
+
+        trials = []
+        for codecName, codec in CODECS.items():
+            compressed = self.compressData(codecName, sample)
+            startTime = time.perf_counter()
+            codec['decompressor']().decompress(compressed)
+            speed = len(sample) / 1048576.0 / max(time.perf_counter() - startTime, 1e-6)
+            trials.append((codecName, len(compressed), speed))
+
+        eligible = [trial for trial in trials if trial[2] >= self.minDecompressSpeed]
+        if not eligible:
+            eligible = [max(trials, key=lambda trial: trial[2])]
+
+        codecName, compressedSize, speed = min(eligible, key=lambda trial: trial[1])
+        self.notify.info('Selected %s for %s (%.1f%% of sample, decompresses at %.2f MB/s).' % (
+            codecName, filepath, compressedSize * 100.0 / len(sample), speed))
+        return codecName
+
+    def compressBlocks(self, f, write, filepath, size, blockExecutor, blockSlots, fileHash, codecName):
+        # Every block becomes its own complete stream. Concatenated streams are
+        # still a valid compressed file, which decompresses to the concatenated data.
+        # A block takes one of the slots shared by every file from when it is read
+        # until it is written, so memory stays bounded however many files are
+        # being compressed at once.
+        pending = []
+        progress = {'bytesDone': 0, 'lastProgress': 0}
+
+        def writeNext():
+            # The block stays pending until written, so a failure still frees its slot.
+            write(pending[0].result())
+            pending.pop(0)
+            blockSlots.release()
+            progress['bytesDone'] = min(size, progress['bytesDone'] + self.compressBlockSize)
+            percent = progress['bytesDone'] * 100 // size
+            if percent - progress['lastProgress'] >= 10 or progress['bytesDone'] == size:
+                self.notify.info('%s: %d%% compressed' % (filepath, percent))
+                progress['lastProgress'] = percent
 
+        try:
+            while True:
+                # Waiting for a free slot while holding some would deadlock with the
+                # other files doing the same, so our own blocks are written instead.
+                while not blockSlots.acquire(blocking=not pending):
+                    writeNext()
+
+                block = f.read(self.compressBlockSize)
+                if not block:
+                    blockSlots.release()
+                    break
+
+                fileHash.update(block)
+                pending.append(blockExecutor.submit(self.compressData, codecName, block))
+
+            while pending:
+                writeNext()
+        finally:
+            for future in pending:
+                future.cancel()
+                blockSlots.release()
+
+    def compressFile(self, filepath, blockExecutor=None, blockSlots=None):
+        # The file is read exactly once: every buffer goes to both the
+        # hasher (for the patch manifest) and the compressor.
+        distDir = os.path.join(self.builtDir, 'dist')
         filename = os.path.basename(filepath)
         directory = os.path.dirname(filepath)
-        if not os.path.exists(os.path.join(distDir, directory)):
-            os.makedirs(os.path.join(distDir, directory))
-
-        bz2Filename = filename + '.bz2'
-        bz2Filepath = os.path.join(distDir, directory, bz2Filename)
-        f = bz2.BZ2File(bz2Filepath, 'w')
-        f.write(data)
-        f.close()
+        os.makedirs(os.path.join(distDir, directory), exist_ok=True)
+        sourcePath = os.path.join(self.builtDir, filepath)
+
+        # If neither the file nor its compressed copy changed since the last
+        # run, the cached digest is reused and nothing has to be compressed.
+        hashCache = self.getHashCache()
+        entry = None if self.forceRebuild else hashCache.lookup(filepath, sourcePath, self.getManifestFileHash)
+        compressed = entry.get('compressed') if entry else None
+        if compressed and compressed.get('codec') in CODECS and self.codec in ('auto', compressed['codec']):
+            compressedFilepath = os.path.join(distDir, directory, filename + CODECS[compressed['codec']]['extension'])
+            if os.path.exists(compressedFilepath):
+                stat = os.stat(compressedFilepath)
+                if compressed.get('size') == stat.st_size and compressed.get('mtime_ns') == stat.st_mtime_ns:
+                    self.notify.info('Up to date: %s' % filepath)
+                    return {'hash': entry['hash'], 'size': entry['size'], 'codec': compressed['codec'],
+                            'compressedSize': stat.st_size, 'compressedHash': compressed['hash']}
+
+        size = os.path.getsize(sourcePath)
+        codecName = self.codec
+        if codecName == 'auto':
+            codecName = self.selectCodec(filepath, sourcePath, size)
+
+        self.notify.info('Compressing: %s (%s)' % (filepath, codecName))
+        record = self.metrics.begin('compress', filepath)
+        startTime = time.perf_counter()
+        fileHash = hashlib.new(self.hashAlgorithm)
+        compressedHash = hashlib.new(self.hashAlgorithm)
+
+        compressedFilepath = os.path.join(distDir, directory, filename + CODECS[codecName]['extension'])
+        with open(sourcePath, 'rb') as f, open(compressedFilepath, 'wb') as out:
+            def write(data):
+                compressedHash.update(data)
+                out.write(data)
+
+            if blockExecutor and self.compressBlockSize and size > self.compressBlockSize and CODECS[codecName]['concatenable']:
+                self.compressBlocks(f, write, filepath, size, blockExecutor, blockSlots or threading.BoundedSemaphore(self.jobs), fileHash, codecName)
+            else:
+                compressor = CODECS[codecName]['compressor']()
+                buffer = self.getReadBuffer()
+                for length in iter(lambda: f.readinto(buffer), 0):
+                    fileHash.update(buffer[:length])
+                    write(compressor.compress(buffer[:length]))
+
+                write(compressor.flush())
+
+            compressedSize = out.tell()
+
+        # Don't leave a copy made with a different codec behind.
+        for otherCodecName, otherCodec in CODECS.items():
+            otherFilepath = os.path.join(distDir, directory, filename + otherCodec['extension'])
+            if otherCodecName != codecName and os.path.exists(otherFilepath):
+                os.remove(otherFilepath)
+
+        stat = os.stat(compressedFilepath)
+        hashCache.store(filepath, sourcePath, fileHash.hexdigest(), compressed={
+            'codec': codecName, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': compressedHash.hexdigest()})
+        self.metrics.end(record, size, compressedSize)
+        elapsed = time.perf_counter() - startTime
+        self.notify.info('Compressed %s: %.2f MB -> %.2f MB in %.2fs (%.2f MB/s)' % (
+            filepath, size / 1048576.0, compressedSize / 1048576.0, elapsed, size / 1048576.0 / max(elapsed, 1e-6)))
+        return {'hash': fileHash.hexdigest(), 'size': size, 'codec': codecName,
+                'compressedSize': compressedSize, 'compressedHash': compressedHash.hexdigest()}
 
     def compressFiles(self):
         self.notify.info('Compressing distributables...')
-        os.chdir(self.builtDir)
-        for filepath in self.getDistributables():
-            self.notify.info('Compressing: %s' % filepath)
-            self.compressFile(filepath)
-
-        os.chdir(self.rootDir)
-        self.notify.info('Successfully compressed distributables.')
+        hashCache = self.getHashCache()
+        startTime = time.perf_counter()
+        results = {}
+
+        # Files are compressed concurrently, and large files additionally have their
+        # blocks spread over a separate pool so one big phase doesn't hold up the rest.
+        # The codecs release the GIL while compressing, so threads are enough here.
+        # At most one block per job is held in memory at a time, across all files.
+        blockSlots = threading.BoundedSemaphore(self.jobs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as blockExecutor:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                futures = {executor.submit(self.compressFile, filepath, blockExecutor, blockSlots): filepath for filepath in self.getDistributables()}
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        results[futures[future]] = future.result()
+                finally:
+                    hashCache.save()
+
+        hashCache.report()
+
+        totalSize = sum(result['size'] for result in results.values())
+        elapsed = time.perf_counter() - startTime
+        self.notify.info('Successfully compressed distributables: %.2f MB in %.2fs (%.2f MB/s)' % (
+            totalSize / 1048576.0, elapsed, totalSize / 1048576.0 / max(elapsed, 1e-6)))
+        return results
+
+    def findChunkBoundary(self, data, start, end):
+        # The caller guarantees data holds at least CHUNK_MAX_SIZE bytes past
+        # start, unless the end of the file has been reached.
+        if end - start <= CHUNK_MIN_SIZE:
+            return end
+
+        limit = min(end, start + CHUNK_MAX_SIZE)
+        i = data.find(CHUNK_ANCHOR, start + CHUNK_MIN_SIZE, limit)
+        while i != -1:
+            if not zlib.crc32(data[i - CHUNK_WINDOW_SIZE + 1:i + 1]) & CHUNK_MASK:
+                return i + 1
+
+            i = data.find(CHUNK_ANCHOR, i + 1, limit)
+
+        return limit
+
+    def getChunkPath(self, digest, codecName):
+        return os.path.join(self.builtDir, 'dist', 'chunks', digest[:2], digest + CODECS[codecName]['extension'])
+
+    def storeChunk(self, chunk, codecName):
+        # Chunks are content addressed, so one that is already in the store
+        # never has to be compressed again.
+        digest = hashlib.new(self.hashAlgorithm, chunk).hexdigest()
+        chunkPath = self.getChunkPath(digest, codecName)
+        if os.path.exists(chunkPath):
+            return digest, False
+
+        os.makedirs(os.path.dirname(chunkPath), exist_ok=True)
+        tempPath = '%s.%d.tmp' % (chunkPath, threading.get_ident())
+        with open(tempPath, 'wb') as f:
+            f.write(self.compressData(codecName, chunk))
+
+        os.replace(tempPath, chunkPath)
+        return digest, True
+
+    def chunkFile(self, filepath):
+        sourcePath = os.path.join(self.builtDir, filepath)
+        hashCache = self.getHashCache()
+        entry = None if self.forceRebuild else hashCache.lookup(filepath, sourcePath, self.getManifestFileHash)
+        if entry and entry.get('codec') in CODECS and self.codec in ('auto', entry['codec']) and 'chunks' in entry:
+            if all(os.path.exists(self.getChunkPath(digest, entry['codec'])) for digest, size in entry['chunks']):
+                self.notify.info('Up to date: %s' % filepath)
+                return {'hash': entry['hash'], 'size': entry['size'], 'codec': entry['codec'], 'chunks': entry['chunks'], 'newChunks': 0}
+
+        size = os.path.getsize(sourcePath)
+        codecName = self.codec
+        if codecName == 'auto':
+            codecName = self.selectCodec(filepath, sourcePath, size)
+
+        self.notify.info('Chunking: %s (%s)' % (filepath, codecName))
+        record = self.metrics.begin('chunk', filepath)
+        fileHash = hashlib.new(self.hashAlgorithm)
+        chunks = []
+        newChunks = 0
+        buffer = bytearray()
+        readBuffer = self.getReadBuffer()
+        eof = False
+        with open(sourcePath, 'rb') as f:
+            while True:
+                while not eof and len(buffer) < CHUNK_MAX_SIZE:
+                    length = f.readinto(readBuffer)
+                    if length:
+                        fileHash.update(readBuffer[:length])
+                        buffer += readBuffer[:length]
+                    else:
+                        eof = True
+
+                if not buffer:
+                    break
+
+                end = self.findChunkBoundary(buffer, 0, len(buffer))
+                digest, new = self.storeChunk(bytes(buffer[:end]), codecName)
+                chunks.append([digest, end])
+                newChunks += new
+                del buffer[:end]
+
+        hashCache.store(filepath, sourcePath, fileHash.hexdigest(), codec=codecName, chunks=chunks)
+        self.metrics.end(record, size)
+        return {'hash': fileHash.hexdigest(), 'size': size, 'codec': codecName, 'chunks': chunks, 'newChunks': newChunks}
+
+    def chunkFiles(self):
+        self.notify.info('Chunking distributables...')
+        hashCache = self.getHashCache()
+        startTime = time.perf_counter()
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {executor.submit(self.chunkFile, filepath): filepath for filepath in self.getDistributables()}
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    results[futures[future]] = future.result()
+            finally:
+                hashCache.save()
+
+        hashCache.report()
+
+        totalSize = sum(result['size'] for result in results.values())
+        totalChunks = sum(len(result['chunks']) for result in results.values())
+        newChunks = sum(result['newChunks'] for result in results.values())
+        elapsed = time.perf_counter() - startTime
+        self.notify.info('Successfully chunked distributables: %.2f MB in %d chunks (%d new) in %.2fs (%.2f MB/s)' % (
+            totalSize / 1048576.0, totalChunks, newChunks, elapsed, totalSize / 1048576.0 / max(elapsed, 1e-6)))
+        return results
+
+    def readDeltaSourceFile(self, filepath):
+        # --delta-from may point at a previous built directory, or at a previous
+        # manifest.json or the dist directory holding it. In the latter case the
+        # old file is recovered from the compressed copy next to the manifest.
+        if os.path.isfile(self.deltaFrom):
+            oldDistDir = os.path.dirname(self.deltaFrom)
+        elif os.path.exists(os.path.join(self.deltaFrom, 'manifest.json')):
+            oldDistDir = self.deltaFrom
+        else:
+            oldFilepath = os.path.join(self.deltaFrom, filepath)
+            if not os.path.exists(oldFilepath):
+                return None
+
+            with open(oldFilepath, 'rb') as f:
+                return f.read()
+
+        if self.deltaManifest is None:
+            with open(os.path.join(oldDistDir, 'manifest.json'), 'r') as f:
+                self.deltaManifest = json.load(f)
+
+        # Manifests from before codecs were selectable are all bz2.
+        codecName = self.deltaManifest['files'].get(filepath, {}).get('codec', 'bz2')
+        if codecName not in CODECS:
+            self.notify.error('Compression codec %s used by %s is not available!' % (codecName, filepath))
+
+        compressedFilepath = os.path.join(oldDistDir, filepath + CODECS[codecName]['extension'])
+        if not os.path.exists(compressedFilepath):
+            return None
+
+        with open(compressedFilepath, 'rb') as f:
+            return b''.join(self.iterDecompressedChunks(f, codecName))
+
+    def buildPatch(self, filepath, result, bsdiff4):
+        # The old file is about as large as the new one, so the new size decides
+        # whether this diff has to wait for the other large ones.
+        if result['size'] > self.patchLargeSize:
+            with self.largePatchLock:
+                return self.diffFile(filepath, result, bsdiff4)
+
+        return self.diffFile(filepath, result, bsdiff4)
+
+    def diffFile(self, filepath, result, bsdiff4):
+        oldData = self.readDeltaSourceFile(filepath)
+        if oldData is None:
+            return None
+
+        # The patch applies to whatever the old file actually contains, so hash
+        # that rather than trusting the old manifest.
+        oldHash = hashlib.new(self.hashAlgorithm, oldData).hexdigest()
+        if oldHash == result['hash']:
+            return None
+
+        with open(os.path.join(self.builtDir, filepath), 'rb') as f:
+            newData = f.read()
+
+        with self.metrics.measure('patch', filepath) as sizes:
+            patchData = bsdiff4.diff(oldData, newData)
+            sizes['bytesRead'] = len(oldData) + len(newData)
+            sizes['bytesWritten'] = len(patchData)
+
+        if len(patchData) >= result['compressedSize'] * PATCH_SIZE_RATIO:
+            self.notify.info('Skipping patch for %s: %d bytes vs %d bytes compressed.' % (filepath, len(patchData), result['compressedSize']))
+            return None
+
+        patchFilename = '%s.%s.patch' % (os.path.basename(filepath), oldHash)
+        with open(os.path.join(self.builtDir, 'dist', os.path.dirname(filepath), patchFilename), 'wb') as f:
+            f.write(patchData)
+
+        self.notify.info('Built patch for %s: %d bytes vs %d bytes compressed.' % (filepath, len(patchData), result['compressedSize']))
+        patch = OrderedDict()
+        patch['from'] = oldHash
+        patch['filename'] = patchFilename
+        patch['hash'] = hashlib.new(self.hashAlgorithm, patchData).hexdigest()
+        patch['size'] = len(patchData)
+        return patch
+
+    def buildPatches(self, results):
+        try:
+            import bsdiff4
+        except:
+            raise ModuleNotFoundError('bsdiff4 was not found! Please install bsdiff4 via pip.')
+
+        self.notify.info('Building delta patches from %s...' % self.deltaFrom)
+        patches = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.jobs, PATCH_JOBS)) as executor:
+            futures = {executor.submit(self.buildPatch, filepath, result, bsdiff4): filepath for filepath, result in results.items()}
+            for future in concurrent.futures.as_completed(futures):
+                patch = future.result()
+                if patch:
+                    patches[futures[future]] = patch
+
+        self.notify.info('Built %d delta patch(es).' % len(patches))
+        return patches
+
+    def removeStalePatches(self, patches):
+        # Patches are named after the hash of the file they apply to, so every
+        # release adds new ones. Only the ones in the new manifest are kept.
+        distDir = os.path.join(self.builtDir, 'dist')
+        keepPaths = set(os.path.join(distDir, os.path.dirname(filepath), patch['filename']) for filepath, patch in (patches or {}).items())
+        removed = 0
+        for dirpath, dirnames, filenames in os.walk(distDir):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                if filename.endswith('.patch') and filepath not in keepPaths:
+                    os.remove(filepath)
+                    removed += 1
+
+        if removed:
+            self.notify.info('Removed %d stale delta patch(es).' % removed)
 
     def buildDist(self):
         self.notify.info('Building distributables...')
@@ -210,27 +2536,550 @@ class FunnyFarmCompilerBase:
         if not os.path.exists(distDir):
             os.makedirs(distDir)
 
-        self.writeManifest()
-        self.compressFiles()
+        patches = None
+        if self.manifestFormat == 'chunked':
+            # Chunks already make updates incremental, so there is nothing to patch.
+            results = self.chunkFiles()
+        else:
+            results = self.compressFiles()
+            if self.deltaFrom:
+                patches = self.buildPatches(results)
+
+        self.writeManifest(results, patches)
+        self.removeStalePatches(patches)
 
         self.notify.info('Done building distributables.')
 
+    def verifyCompressedFile(self, compressedPath, codecName, algorithm):
+        # Returns the digests of the compressed and decompressed contents and the
+        # decompressed size, reading the file once without keeping more than a
+        # few buffers of it in memory. A decompression error is returned rather
+        # than raised, after hashing the rest of the file.
+        compressedHash = hashlib.new(algorithm)
+        fileHash = hashlib.new(algorithm)
+        size = 0
+        error = None
+        with open(compressedPath, 'rb') as f:
+            try:
+                for data in self.iterDecompressedChunks(f, codecName, compressedHash):
+                    fileHash.update(data)
+                    size += len(data)
+            except Exception as e:
+                error = e
+                for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+                    compressedHash.update(chunk)
+
+        return compressedHash.hexdigest(), fileHash.hexdigest(), size, error
+
+    def verifyFile(self, filepath, entry, manifest):
+        # Returns the problems found with one file of the manifest as (kind, name,
+        # detail) tuples, and the number of compressed and decompressed bytes read.
+        with self.metrics.measure('verify', filepath) as sizes:
+            problems, bytesRead, bytesVerified = self.checkFile(filepath, entry, manifest)
+            sizes['bytesRead'] = bytesRead
+
+        return problems, bytesRead, bytesVerified
+
+    def checkFile(self, filepath, entry, manifest):
+        distDir = os.path.join(self.builtDir, 'dist')
+        algorithm = manifest.get('hash-algorithm', 'md5')
+        problems = []
+        bytesRead = bytesVerified = 0
+
+        # Manifests from before codecs were selectable are all bz2.
+        codecName = entry.get('codec', 'bz2')
+        if codecName not in CODECS:
+            return [('corrupt', filepath, 'compression codec %s is not available' % codecName)], 0, 0
+
+        extension = CODECS[codecName]['extension']
+        try:
+            if manifest.get('format') == 'chunked':
+                fileHash = hashlib.new(algorithm)
+                for digest, length in entry['chunks']:
+                    chunkName = '%s/%s/%s%s' % (manifest.get('chunk-store', 'chunks'), digest[:2], digest, extension)
+                    chunkPath = os.path.join(distDir, *chunkName.split('/'))
+                    if not os.path.exists(chunkPath):
+                        problems.append(('missing', chunkName, 'chunk of %s' % filepath))
+                        continue
+
+                    chunkHash = hashlib.new(algorithm)
+                    chunkSize = 0
+                    try:
+                        with open(chunkPath, 'rb') as f:
+                            for data in self.iterDecompressedChunks(f, codecName):
+                                chunkHash.update(data)
+                                fileHash.update(data)
+                                chunkSize += len(data)
+                    except Exception as e:
+                        problems.append(('corrupt', chunkName, 'chunk of %s, %s: %s' % (filepath, type(e).__name__, e)))
+                        continue
+
+                    bytesRead += os.path.getsize(chunkPath)
+                    bytesVerified += chunkSize
+                    if chunkHash.hexdigest() != digest or chunkSize != length:
+                        problems.append(('corrupt', chunkName, 'chunk of %s does not match its hash or size' % filepath))
+
+                if not problems and fileHash.hexdigest() != entry['hash']:
+                    problems.append(('corrupt', filepath, 'reassembled chunks do not match the file hash'))
+            else:
+                compressedName = filepath + extension
+                compressedPath = os.path.join(distDir, *compressedName.split('/'))
+                if not os.path.exists(compressedPath):
+                    problems.append(('missing', compressedName, ''))
+                else:
+                    bytesRead += os.path.getsize(compressedPath)
+                    if 'compressedSize' in entry and os.path.getsize(compressedPath) != entry['compressedSize']:
+                        problems.append(('corrupt', compressedName, 'size is %d, expected %d' % (os.path.getsize(compressedPath), entry['compressedSize'])))
+                    else:
+                        compressedDigest, digest, size, error = self.verifyCompressedFile(compressedPath, codecName, algorithm)
+                        bytesVerified += size
+                        if 'compressedHash' in entry and compressedDigest != entry['compressedHash']:
+                            problems.append(('corrupt', compressedName, 'compressed hash does not match'))
+                        elif error is not None:
+                            problems.append(('corrupt', compressedName, '%s: %s' % (type(error).__name__, error)))
+                        elif digest != entry['hash'] or size != entry.get('size', size):
+                            problems.append(('corrupt', compressedName, 'decompressed contents do not match'))
+        except Exception as e:
+            # Truncated or garbled data makes the decompressor give up.
+            problems.append(('corrupt', filepath, '%s: %s' % (type(e).__name__, e)))
+
+        patch = entry.get('patch')
+        if patch:
+            patchName = posixpath.join(entry.get('path', ''), patch['filename'])
+            patchPath = os.path.join(distDir, *patchName.split('/'))
+            if not os.path.exists(patchPath):
+                problems.append(('missing', patchName, 'patch of %s' % filepath))
+            elif os.path.getsize(patchPath) != patch['size'] or self.getFileHash(patchPath, algorithm) != patch['hash']:
+                problems.append(('corrupt', patchName, 'patch of %s does not match its hash or size' % filepath))
+            else:
+                bytesRead += patch['size']
+
+        return problems, bytesRead, bytesVerified
+
+    def verify(self):
+        distDir = os.path.join(self.builtDir, 'dist')
+        manifestPath = os.path.join(distDir, 'manifest.json')
+        if not os.path.exists(manifestPath):
+            self.notify.error('No patch manifest found, the distributables must be built before verifying them!')
+
+        with open(manifestPath, 'r') as f:
+            manifest = json.load(f)
+
+        files = manifest.get('files', {})
+        self.notify.info('Verifying %d distributables using %d job(s)...' % (len(files), self.jobs))
+        startTime = time.perf_counter()
+        problems = []
+        bytesRead = bytesVerified = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(self.verifyFile, filepath, entry, manifest) for filepath, entry in files.items()]
+            for future in concurrent.futures.as_completed(futures):
+                fileProblems, fileBytesRead, fileBytesVerified = future.result()
+                problems += fileProblems
+                bytesRead += fileBytesRead
+                bytesVerified += fileBytesVerified
+
+        # Anything in dist that the manifest doesn't refer to is extra.
+        expected = set(self.getPublishObjects(manifest))
+        expected.add('manifest.json')
+        for dirpath, dirnames, filenames in os.walk(distDir):
+            for filename in filenames:
+                name = os.path.relpath(os.path.join(dirpath, filename), distDir).replace(os.sep, '/')
+                if name not in expected:
+                    problems.append(('extra', name, ''))
+
+        elapsed = time.perf_counter() - startTime
+        self.notify.info('Verified %.2f MB compressed, %.2f MB decompressed in %.2fs (%.2f MB/s).' % (
+            bytesRead / 1048576.0, bytesVerified / 1048576.0, elapsed, bytesVerified / 1048576.0 / max(elapsed, 1e-6)))
+
+        counts = {'missing': 0, 'corrupt': 0, 'extra': 0}
+        for kind, name, detail in sorted(problems):
+            counts[kind] += 1
+            self.notify.warning('%s: %s%s' % (kind.capitalize(), name, ' (%s)' % detail if detail else ''))
+
+        # Extra files don't break anything, the launcher never asks for them.
+        if counts['missing'] or counts['corrupt']:
+            self.notify.error('Verification failed: %(missing)d missing, %(corrupt)d corrupt, %(extra)d extra.' % counts)
+
+        self.notify.info('Verification passed: %(extra)d extra file(s).' % counts)
+
+    def getPublishObjects(self, manifest):
+        # Maps every object a manifest refers to, relative to the dist directory,
+        # to the key it is published under. Chunks are content-addressed already;
+        # manifests from before the object store publish everything in place.
+        objects = OrderedDict()
+        objectStore = manifest.get('object-store')
+
+        def getKey(name, digest, extension):
+            if objectStore:
+                return '%s/%s/%s%s' % (objectStore, digest[:2], digest, extension)
+
+            return name
+
+        for filepath, entry in manifest.get('files', {}).items():
+            # Manifests from before codecs were selectable are all bz2.
+            codecName = entry.get('codec', 'bz2')
+            extension = CODECS[codecName]['extension'] if codecName in CODECS else '.' + codecName
+            if manifest.get('format') == 'chunked':
+                for digest, length in entry['chunks']:
+                    chunkName = '%s/%s/%s%s' % (manifest.get('chunk-store', 'chunks'), digest[:2], digest, extension)
+                    objects[chunkName] = chunkName
+            else:
+                objects[filepath + extension] = getKey(filepath + extension, entry.get('compressedHash', entry['hash']), extension)
+
+            patch = entry.get('patch')
+            if patch:
+                patchName = posixpath.join(entry.get('path', ''), patch['filename'])
+                objects[patchName] = getKey(patchName, patch['hash'], '.patch')
+
+        return objects
+
+    def publish(self):
+        if not self.publishTarget:
+            self.notify.error('No publish target set!')
+
+        distDir = os.path.join(self.builtDir, 'dist')
+        manifestPath = os.path.join(distDir, 'manifest.json')
+        if not os.path.exists(manifestPath):
+            self.notify.error('No patch manifest found, the distributables must be built before publishing!')
+
+        self.notify.info('Publishing distributables...')
+        with open(manifestPath, 'r') as f:
+            manifest = json.load(f)
+
+        publishedKeys = set()
+        try:
+            oldManifest = self.publishTarget.readFile('manifest.json')
+            if oldManifest is not None:
+                publishedKeys = set(self.getPublishObjects(json.loads(oldManifest.decode('utf-8'))).values())
+        except (ValueError, KeyError, TypeError) as e:
+            self.notify.warning('The published patch manifest is unreadable, publishing everything: %s' % e)
+
+        # Keys change with the contents, so only keys the published manifest
+        # doesn't refer to are uploaded, and identical files only once. Nothing
+        # is overwritten, so clients still on the old manifest are unaffected.
+        objects = self.getPublishObjects(manifest)
+        changed = OrderedDict()
+        for name, key in objects.items():
+            if key not in publishedKeys:
+                changed.setdefault(key, name)
+
+        self.notify.info('Uploading %d of %d objects using %d job(s)...' % (len(changed), len(set(objects.values())), self.jobs))
+
+        def upload(key, name):
+            sourcePath = os.path.join(distDir, *name.split('/'))
+            with self.metrics.measure('upload', name) as sizes:
+                self.publishTarget.uploadFile(key, sourcePath)
+                sizes['bytesWritten'] = os.path.getsize(sourcePath)
+
+            return sizes['bytesWritten']
+
+        startTime = time.perf_counter()
+        uploaded = 0
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                futures = {executor.submit(upload, key, name): name for key, name in changed.items()}
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        uploaded += future.result()
+                    except Exception as e:
+                        for pending in futures:
+                            pending.cancel()
+
+                        self.notify.error('Failed to upload %s! (%s)' % (futures[future], e))
+
+            # The manifest goes last, so clients never see it before everything
+            # it refers to has been uploaded.
+            self.publishTarget.uploadFile('manifest.json', manifestPath)
+        finally:
+            self.publishTarget.close()
+
+        elapsed = time.perf_counter() - startTime
+        self.notify.info('Successfully published distributables: %.2f MB in %.2fs (%.2f MB/s)' % (
+            uploaded / 1048576.0, elapsed, uploaded / 1048576.0 / max(elapsed, 1e-6)))
+
+    def getGameBuildInputSize(self):
+        # Size of what the compiler reads from the working directory.
+        size = 0
+        for sourceDir in self.sourceDirs:
+            size += self.getTreeSize(os.path.join(self.workingDir, sourceDir))
+
+        for filename in (os.path.basename(self.mainFile), 'gamedata.py'):
+            if os.path.exists(os.path.join(self.workingDir, filename)):
+                size += os.path.getsize(os.path.join(self.workingDir, filename))
+
+        return size
+
+    def buildAndCopyGame(self, copySources=True):
+        # Without copySources, only gamedata.py is regenerated before compiling,
+        # which is enough when nothing but the config changed since the last build.
+        if self.profileStartup:
+            self.notify.warning('Building with startup profiling, this build should not be released!')
+
+        fingerprint = self.getGameFingerprint()
+        if not self.forceRebuild and fingerprint == self.readGameFingerprint():
+            self.notify.info('Game sources are unchanged, reusing the existing build.')
+        else:
+            if copySources or self.readGameFingerprint() is None:
+                with self.metrics.measure('copyBuildFiles') as sizes:
+                    sizes['bytesRead'] = sizes['bytesWritten'] = self.copyBuildFiles()
+
+            if os.path.exists(self.getGameFingerprintPath()):
+                os.remove(self.getGameFingerprintPath())
+
+            gameDataPath = os.path.join(self.workingDir, 'gamedata.py')
+            with self.metrics.measure('generateGameData') as sizes:
+                self.generateGameData(self.configFile)
+                if os.path.exists(gameDataPath):
+                    sizes['bytesRead'] = os.path.getsize(os.path.join(self.baseDir, self.configFile))
+                    sizes['bytesWritten'] = os.path.getsize(gameDataPath)
+
+            with self.metrics.measure('buildGame') as sizes:
+                self.buildGame()
+                sizes['bytesRead'] = self.getGameBuildInputSize()
+                sizes['bytesWritten'] = self.getTreeSize(os.path.join(self.workingDir, '%s.dist' % self.getMainFileName()))
+
+            self.writeGameFingerprint(fingerprint)
+
+        with self.metrics.measure('copyToBuiltDir') as sizes:
+            self.copyToBuiltDir()
+            sizes['bytesRead'] = sizes['bytesWritten'] = sum(os.path.getsize(os.path.join(self.builtDir, filepath)) for filepath in self.getDistributables()
+                                                             if not filepath.startswith('resources/') and os.path.isfile(os.path.join(self.builtDir, filepath)))
+
+    def getGameInputs(self):
+        inputs = [os.path.join(self.baseDir, sourceDir) for sourceDir in self.sourceDirs] + self.getEntryPointFiles()
+        if self.configFile:
+            inputs.append(os.path.join(self.baseDir, self.configFile))
+
+        return inputs
+
+    def measureStage(self, name, function):
+        # Returns a callable that runs the stage function and records it as a metric.
+        def stage():
+            with self.metrics.measure('stage', name) as sizes:
+                since = time.perf_counter() - self.metrics.startTime
+                function()
+                sizes['bytesRead'], sizes['bytesWritten'] = self.metrics.getTotals(STAGE_STEPS.get(name, []), since)
+
+        return stage
+
+    def writeMetricsReport(self, command, error=None):
+        # Every build writes its own report, they are kept across builds. Failed
+        # builds too, with the error that stopped them.
+        reportPath = os.path.join(self.workingDir, 'metrics', '%s-%s.json' % (command, self.metrics.startDate.strftime('%Y%m%d-%H%M%S')))
+        try:
+            self.metrics.writeReport(reportPath, command, error)
+        except OSError as e:
+            # Don't hide the error that stopped the build.
+            self.notify.warning('Unable to write the build metrics: %s' % e)
+            return None
+
+        return reportPath
+
+    def getGameStageOutputs(self):
+        return [os.path.join(self.builtDir, filepath) for filepath in self.getDistributables() if not filepath.startswith('resources/')]
+
+    def getGameStageOptions(self):
+        return {'version': self.version, 'compilerCommand': self.getCompilerCommand(), 'compilerVersion': self.getCompilerVersion().decode('utf-8', 'replace'),
+                'compilerFlags': self.compilerFlags, 'profileStartup': self.profileStartup}
+
+    def getResourceStageInputs(self):
+        return [os.path.join(self.baseDir, 'resources')]
+
+    def getResourceStageOutputs(self):
+        resourcesDir = os.path.join(self.baseDir, 'resources')
+        return [os.path.join(self.builtDir, 'resources', phase + '.mf') for phase in os.listdir(resourcesDir) if phase.startswith('phase_')]
+
+    def getResourceStageOptions(self):
+        return {'packing': self.getPackingOptions(), 'preprocess': self.preprocess, 'converters': self.getConverters() if self.preprocess else None,
+                'dedupeResources': self.dedupeResources, 'resourceStore': self.resourceStore.storeDir if self.resourceStore else None}
+
+    def getDistStageInputs(self):
+        inputs = [os.path.join(self.builtDir, filepath) for filepath in self.getDistributables()]
+        if self.deltaFrom:
+            inputs.append(os.path.abspath(self.deltaFrom))
+
+        return inputs
+
+    def getDistStageOutputs(self):
+        # The manifest and everything it refers to.
+        distDir = os.path.join(self.builtDir, 'dist')
+        manifestPath = os.path.join(distDir, 'manifest.json')
+        try:
+            with open(manifestPath, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return [manifestPath]
+
+        return [manifestPath] + [os.path.join(distDir, *name.split('/')) for name in self.getPublishObjects(manifest)]
+
+    def getDistStageOptions(self):
+        return {'version': self.version, 'launcherVersion': self.launcherVersion, 'hashAlgorithm': self.hashAlgorithm, 'codec': self.codec,
+                'minDecompressSpeed': self.minDecompressSpeed if self.codec == 'auto' else None, 'manifestFormat': self.manifestFormat,
+                'compressBlockSize': self.compressBlockSize, 'launchPhases': self.launchPhases}
+
+    def hashStageFiles(self, filepaths):
+        # Stage fingerprints only read the files that changed since they were last hashed.
+        hashCache = self.getWorkingHashCache('stages-hashcache.json')
+
+        def getFileHash(filepath):
+            entry = hashCache.lookup(filepath, filepath, self.getFileHash)
+            if entry:
+                return entry['hash']
+
+            digest = self.getFileHash(filepath)
+            hashCache.store(filepath, filepath, digest)
+            return digest
+
+        return list(self.getHashExecutor().map(getFileHash, filepaths))
+
+    def buildAll(self):
+        # The game and the resources don't depend on each other, so they are
+        # built at the same time; the distributables need both to be finished.
+        # Stages whose inputs, options and outputs match their last run are skipped.
+        scheduler = FunnyFarmStageScheduler(os.path.join(self.workingDir, 'stages.json'), self.hashStageFiles, self.forceRebuild)
+        scheduler.addStage(FunnyFarmBuildStage('game', self.measureStage('game', self.buildAndCopyGame),
+                                               inputs=self.getGameInputs, outputs=self.getGameStageOutputs, options=self.getGameStageOptions))
+        scheduler.addStage(FunnyFarmBuildStage('resources', self.measureStage('resources', self.buildResources),
+                                               inputs=self.getResourceStageInputs, outputs=self.getResourceStageOutputs, options=self.getResourceStageOptions))
+        scheduler.addStage(FunnyFarmBuildStage('dist', self.measureStage('dist', self.buildDist), ['game', 'resources'],
+                                               inputs=self.getDistStageInputs, outputs=self.getDistStageOutputs, options=self.getDistStageOptions))
+        try:
+            scheduler.run()
+        finally:
+            self.getWorkingHashCache('stages-hashcache.json').save()
+
+    def getWatchPaths(self):
+        # The game is only watched if it is being built.
+        paths = [os.path.join(self.baseDir, 'resources')]
+        if self.mainFile:
+            paths += self.getGameInputs()
+
+        return paths
+
+    def isPathWithin(self, path, directory):
+        return path == directory or path.startswith(directory + os.sep)
+
+    def getWatchTargets(self, paths):
+        # Returns the phases to rebuild (None for all of them) and whether the
+        # game needs rebuilding because of its sources, its config or not at all.
+        resourcesDir = os.path.join(self.baseDir, 'resources')
+        configPath = os.path.join(self.baseDir, self.configFile) if self.configFile else None
+        phases = set()
+        allPhases = False
+        game = None
+        for path in paths:
+            if self.isPathWithin(path, resourcesDir):
+                relpath = os.path.relpath(path, resourcesDir)
+                if relpath == '.':
+                    allPhases = True
+                elif relpath.split(os.sep)[0].startswith('phase_'):
+                    phases.add(relpath.split(os.sep)[0])
+            elif self.mainFile and path == configPath:
+                game = game or 'config'
+            elif self.mainFile and any(self.isPathWithin(path, sourcePath) for sourcePath in self.getGameInputs()):
+                game = 'sources'
+
+        # Added or removed phases change the phase list, and deduplicated phases
+        # depend on each other, so both need every phase to be looked at.
+        if any(not os.path.isdir(os.path.join(resourcesDir, phase)) for phase in phases):
+            allPhases = True
+
+        if phases and self.dedupeResources:
+            allPhases = True
+
+        return (None if allPhases else phases), game
+
+    def rebuild(self, phases, game):
+        # The game and the resources are rebuilt at the same time, like buildAll.
+        scheduler = FunnyFarmStageScheduler()
+        if game:
+            scheduler.addStage(FunnyFarmBuildStage('game', self.measureStage('game', lambda: self.buildAndCopyGame(game == 'sources'))))
+
+        if phases is None or phases:
+            scheduler.addStage(FunnyFarmBuildStage('resources', self.measureStage('resources', lambda: self.buildResources(phases))))
+
+        scheduler.run()
+
+    def watch(self):
+        self.treeHashCache = FunnyFarmHashCache(None, self.verifyHashCache)
+        watcher = FunnyFarmFileWatcher(self.getWatchPaths())
+        watcher.start()
+        self.notify.info('Watching for changes %s, press Ctrl+C to stop.' % ('natively' if watcher.observer is not None else 'by polling'))
+        try:
+            # Start from an up to date build, anything unchanged is skipped.
+            phases, game = None, 'sources' if self.mainFile else None
+            while True:
+                startTime = time.perf_counter()
+                self.metrics = FunnyFarmBuildMetrics()
+                error = None
+                try:
+                    self.rebuild(phases, game)
+                    self.notify.info('Rebuilt in %.2fs, waiting for changes...' % (time.perf_counter() - startTime))
+                except Exception as e:
+                    # A broken asset or source shouldn't stop the watch, the next change may fix it.
+                    error = e
+                    self.notify.warning('Rebuild failed, waiting for changes: %s' % e)
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    # Every rebuild gets its own report.
+                    self.writeMetricsReport('watch', error)
+
+                phases, game = set(), None
+                while not phases and phases is not None and not game:
+                    changes = watcher.waitForChanges()
+                    phases, game = self.getWatchTargets(changes)
+
+                targets = ['all phases'] if phases is None else sorted(phases)
+                if game:
+                    targets.append('the game %s' % game)
+
+                self.notify.info('Changes detected in %s.' % ', '.join(targets))
+        except KeyboardInterrupt:
+            self.notify.info('Stopped watching.')
+        finally:
+            watcher.close()
+
     def run(self, command):
         self.builtDir = os.path.join(self.workingDir, 'built')
         if not os.path.exists(self.builtDir):
             os.makedirs(self.builtDir)
 
-        if command == 'buildGame':
-            self.copyBuildFiles()
-            self.generateGameData(self.configFile)
-            self.buildGame()
-            self.copyToBuiltDir()
-        elif command == 'buildResources':
-            self.buildResources()
-        elif command == 'buildDist':
-            self.buildDist()
-        else:
-            self.notify.error('Unknown command: %s' % command)
+        self.metrics = FunnyFarmBuildMetrics()
+
+        error = None
+        try:
+            if command == 'buildGame':
+                self.measureStage('game', self.buildAndCopyGame)()
+            elif command == 'buildAll':
+                self.buildAll()
+            elif command == 'buildResources':
+                self.measureStage('resources', self.buildResources)()
+            elif command == 'buildDist':
+                self.measureStage('dist', self.buildDist)()
+            elif command == 'watch':
+                self.watch()
+            elif command == 'verify':
+                self.measureStage('verify', self.verify)()
+            elif command == 'analyzeDuplicates':
+                self.measureStage('analyzeDuplicates', self.analyzeDuplicates)()
+            elif command == 'publish':
+                self.measureStage('publish', self.publish)()
+            else:
+                self.notify.error('Unknown command: %s' % command)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            with self.hashExecutorLock:
+                if self.hashExecutor:
+                    self.hashExecutor.shutdown()
+                    self.hashExecutor = None
+
+            # Watching writes a report after every rebuild instead.
+            if command != 'watch':
+                self.writeMetricsReport(command, error)
 
 
 class FunnyFarmCompilerWindows(FunnyFarmCompilerBase):
@@ -243,22 +3092,6 @@ class FunnyFarmCompilerWindows(FunnyFarmCompilerBase):
         self.panda3dDevDir = os.path.join(self.rootDir, 'funny-farm-panda3d', 'built_dev_%s' % self.arch)
         self.panda3dProdDir = os.path.join(self.rootDir, 'funny-farm-panda3d', 'built_prod_%s' % self.arch)
 
-    def removeOldBuildFiles(self):
-        # on windows we want to preserve the build directory
-        # as it contains cache which will speed up the build
-        # process if we need to build the game again.
-        if os.path.exists(self.workingDir):
-            self.notify.info('Cleaning up old build files...')
-            for item in os.listdir(self.workingDir):
-                if item == 'built' or item == '%s.build' % os.path.splitext(os.path.basename(self.mainFile))[0]:
-                    continue
-
-                itemPath = os.path.join(self.workingDir, item)
-                if os.path.isdir(itemPath):
-                    shutil.rmtree(itemPath)
-                else:
-                    os.remove(itemPath)
-
     def copyToBuiltDir(self):
         self.notify.info('Copying to built directory...')
         distDir = os.path.join(self.workingDir, '%s.dist' % os.path.splitext(os.path.basename(self.mainFile))[0])
@@ -299,9 +3132,9 @@ class FunnyFarmCompilerWindows(FunnyFarmCompilerBase):
                 if not os.path.exists(destDirName):
                     os.makedirs(destDirName)
 
-                shutil.copy(os.path.join(distDir, sourceDirName, basename), os.path.join(destDirName, basename))
+                self.copyFile(os.path.join(distDir, sourceDirName, basename), os.path.join(destDirName, basename))
             else:
-                shutil.copy(os.path.join(distDir, sourceDirName, basename), os.path.join(self.builtDir, destDirName, basename))
+                self.copyFile(os.path.join(distDir, sourceDirName, basename), os.path.join(self.builtDir, destDirName, basename))
 
         if not os.path.exists(self.panda3dProdDir):
             return
@@ -314,7 +3147,7 @@ class FunnyFarmCompilerWindows(FunnyFarmCompilerBase):
         ]
 
         for pandaDll in pandaDlls:
-            shutil.copy(os.path.join(self.panda3dProdDir, 'bin', pandaDll), self.builtDir)
+            self.copyFile(os.path.join(self.panda3dProdDir, 'bin', pandaDll), self.builtDir)
 
         self.notify.info('Successfully copied to built directory!')
 
@@ -440,9 +3273,9 @@ class FunnyFarmCompilerDarwin(FunnyFarmCompilerBase):
                 if not os.path.exists(destDirName):
                     os.makedirs(destDirName)
 
-                shutil.copy(os.path.join(distDir, sourceDirName, basename), os.path.join(destDirName, basename))
+                self.copyFile(os.path.join(distDir, sourceDirName, basename), os.path.join(destDirName, basename))
             else:
-                shutil.copy(os.path.join(distDir, sourceDirName, basename), os.path.join(self.builtDir, destDirName, basename))
+                self.copyFile(os.path.join(distDir, sourceDirName, basename), os.path.join(self.builtDir, destDirName, basename))
 
         if not os.path.exists(self.panda3dProdDir):
             return
@@ -454,14 +3287,14 @@ class FunnyFarmCompilerDarwin(FunnyFarmCompilerBase):
         ]
 
         for pandaDylib in pandaDylibs:
-            shutil.copy(os.path.join(self.panda3dProdDir, 'lib', pandaDylib), self.builtDir)
+            self.copyFile(os.path.join(self.panda3dProdDir, 'lib', pandaDylib), self.builtDir)
 
         # Copy Cg.framework/Cg too.
         cgFrameworkDir = os.path.join(self.builtDir, 'Cg.framework')
         if not os.path.exists(cgFrameworkDir):
             os.makedirs(cgFrameworkDir)
 
-        shutil.copy(os.path.join(self.panda3dProdDir, 'Frameworks', 'Cg.framework', 'Cg'), cgFrameworkDir)
+        self.copyFile(os.path.join(self.panda3dProdDir, 'Frameworks', 'Cg.framework', 'Cg'), cgFrameworkDir)
 
         self.fixMacLibs()
 
@@ -520,39 +3353,149 @@ class FunnyFarmCompilerDarwin(FunnyFarmCompilerBase):
         return distributables
 
 
-parser = argparse.ArgumentParser(description='Build script for Toontown\'s Funny Farm')
-parser.add_argument('--version', '-v', help='Game version', required=True)
-parser.add_argument('--launcher', '-l', help='Launcher version')
-parser.add_argument('--resources', '-r', help='Builds the game resources (phases).', action='store_true')
-parser.add_argument('--game', '-g', help='Builds the game source code.', action='store_true')
-parser.add_argument('--dist', '-d', help='Generate distributable (patch manifest) files.', action='store_true')
-if sys.platform == 'win32':
-    parser.add_argument('--arch', '-a', help='Target architecture', choices=['win32', 'win64'], required=True)
+def main():
+    parser = argparse.ArgumentParser(description='Build script for Toontown\'s Funny Farm')
+    parser.add_argument('--version', '-v', help='Game version', required=True)
+    parser.add_argument('--launcher', '-l', help='Launcher version')
+    parser.add_argument('--resources', '-r', help='Builds the game resources (phases).', action='store_true')
+    parser.add_argument('--game', '-g', help='Builds the game source code.', action='store_true')
+    parser.add_argument('--dist', '-d', help='Generate distributable (patch manifest) files.', action='store_true')
+    parser.add_argument('--all', help='Builds the game, resources and distributables, running independent stages concurrently.', action='store_true')
+    parser.add_argument('--watch', help='Keep running and rebuild the phases that change, and the game too with --game or --all, whenever their sources change.', action='store_true')
+    parser.add_argument('--force', '-f', help='Rebuild everything, even if it is up to date.', action='store_true')
+    parser.add_argument('--profile-startup', help='Build an instrumented entry point that logs startup timings to startup-profile.log. Not for release builds.', action='store_true')
+    parser.add_argument('--packer', help='Pack phases with the built-in multifile writer, or the multify binary from the Panda3D SDK. (default: native)', choices=['native', 'multify'], default='native')
+    parser.add_argument('--shared-resources', help='Pack phases into a resource store shared between targets and link them into each built directory. Always on when building several architectures.', action='store_true')
+    parser.add_argument('--resource-store', help='Directory of the shared resource store, implies --shared-resources. (default: builds/resource-store)')
+    parser.add_argument('--analyze-duplicates', help='Report resource files that are duplicated across phases.', action='store_true')
+    parser.add_argument('--dedupe-resources', help='Only pack files duplicated across phases into the earliest phase loading them, listing the others in each phase\'s %s. Requires the native packer and a game that applies the redirects.' % DEDUPE_REDIRECTS_NAME, action='store_true')
+    parser.add_argument('--preprocess', help='Convert assets into their runtime formats (e.g. .egg to .bam) before packing the phases.', action='store_true')
+    parser.add_argument('--converter', help='Convert assets with the FROM extension into TO files using COMMAND, in which {input} and {output} are replaced by the file paths. (default: .egg .bam "egg2bam -o {output} {input}")', nargs=3, metavar=('FROM', 'TO', 'COMMAND'), action='append', default=[])
+    parser.add_argument('--mf-compression', help='zlib compression level (0-9) for subfiles packed by the native packer. Already compressed media is always stored. (default: 0)', type=int, choices=range(10), default=0)
+    parser.add_argument('--compress-block-size', help='Split distributables larger than this many MB into blocks compressed in parallel. 0 disables splitting. (default: 16)', type=int, default=COMPRESS_BLOCK_SIZE // 1048576)
+    parser.add_argument('--codec', help='Compression codec for distributables. auto picks the smallest within --min-decompress-speed. (default: bz2)', choices=list(CODECS.keys()) + ['auto'], default='bz2')
+    parser.add_argument('--min-decompress-speed', help='Decompression speed budget in MB/s used by --codec auto. (default: 50)', type=float, default=50)
+    parser.add_argument('--sync', help='Only copy changed build files instead of recopying the sources on every game build.', action='store_true')
+    parser.add_argument('--compiler-command', help='Command used to invoke Nuitka. (default: python -OO -m nuitka)')
+    parser.add_argument('--manifest-format', help='Write a whole-file manifest, or a chunked one backed by a content-addressed chunk store. (default: files)', choices=['files', 'chunked'], default='files')
+    parser.add_argument('--hash-algorithm', help='Hash algorithm used by the patch manifest. Older launchers only understand md5. (default: md5)', choices=HASH_ALGORITHMS, default='md5')
+    parser.add_argument('--delta-from', help='Previous built directory or manifest to build delta patches against.')
+    parser.add_argument('--patch-large-size', help='Diff distributables larger than this many MB one at a time, since bsdiff needs several times the file size in memory. (default: %d)' % (PATCH_LARGE_SIZE // 1048576), type=int, default=PATCH_LARGE_SIZE // 1048576)
+    parser.add_argument('--verify-hash-cache', help='Verify hash cache entries by file contents instead of size and mtime.', action='store_true')
+    parser.add_argument('--verify', help='Check every distributable against the patch manifest, after building and before publishing.', action='store_true')
+    parser.add_argument('--publish', help='Upload changed distributables to a directory, an http(s):// URL taking PUT requests, or an s3+http(s)://endpoint/bucket/prefix URL (credentials are read from AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and AWS_DEFAULT_REGION). {arch} is replaced with the architecture.')
+    parser.add_argument('--publish-header', help='Extra "Name: value" header sent with every HTTP publish request.', action='append', default=[])
+    parser.add_argument('--jobs', '-j', help='Number of parallel build jobs. (default: CPU count)', type=int, default=os.cpu_count() or 1)
+    if sys.platform == 'win32':
+        parser.add_argument('--arch', '-a', help='Target architecture(s)', choices=['win32', 'win64'], nargs='+', required=True)
+
+    args = parser.parse_args()
+
+    if sys.platform not in ('win32', 'darwin'):
+        raise Exception('Platform not supported: %s' % sys.platform)
+
+    if (args.dist or args.all) and not args.launcher:
+        raise Exception('Launcher version must be set to build distributables!')
+
+    publishHeaders = {}
+    for header in args.publish_header:
+        name, separator, value = header.partition(':')
+        if not separator:
+            raise Exception('Invalid publish header: %s' % header)
+
+        publishHeaders[name.strip()] = value.strip()
+
+    compilers = []
+    if (args.game or args.dist or args.resources or args.all or args.watch or args.verify or args.publish or args.analyze_duplicates):
+        if sys.platform == 'win32':
+            for arch in OrderedDict.fromkeys(args.arch):
+                compilers.append(FunnyFarmCompilerWindows(args.version, args.launcher, arch))
+        elif sys.platform == 'darwin':
+            compilers.append(FunnyFarmCompilerDarwin(args.version, args.launcher))
+
+        # Resources are the same for every target, so when building more than
+        # one they are packed once into the store and linked into each target.
+        resourceStore = None
+        if args.shared_resources or args.resource_store or len(compilers) > 1:
+            storeDir = os.path.abspath(args.resource_store) if args.resource_store else os.path.join(os.getcwd(), 'builds', 'resource-store')
+            resourceStore = FunnyFarmResourceStore(storeDir)
+
+    if args.watch and len(compilers) > 1:
+        raise Exception('--watch only supports building a single architecture!')
+
+    for compiler in compilers:
+        compiler.setJobs(args.jobs)
+        compiler.setForceRebuild(args.force)
+        compiler.setCompressBlockSize(args.compress_block_size * 1048576)
+        compiler.setVerifyHashCache(args.verify_hash_cache)
+        compiler.setHashAlgorithm(args.hash_algorithm)
+        compiler.setDeltaFrom(args.delta_from)
+        compiler.setPatchLargeSize(args.patch_large_size * 1048576)
+        compiler.setCodec(args.codec)
+        compiler.setMinDecompressSpeed(args.min_decompress_speed)
+        compiler.setManifestFormat(args.manifest_format)
+        compiler.setSyncBuildFiles(args.sync)
+        compiler.setPacker(args.packer)
+        compiler.setMultifileCompressionLevel(args.mf_compression)
+        compiler.setResourceStore(resourceStore)
+        compiler.setPreprocess(args.preprocess)
+        compiler.setDedupeResources(args.dedupe_resources)
+        compiler.setProfileStartup(args.profile_startup)
+        for sourceExtension, targetExtension, command in args.converter:
+            compiler.addConverter(sourceExtension, targetExtension, shlex.split(command, posix=(os.name != 'nt')))
+
+        if args.compiler_command:
+            compiler.setCompilerCommand(shlex.split(args.compiler_command, posix=(os.name != 'nt')))
+
+        if args.publish:
+            # Every architecture has its own distributables, so they need their own target.
+            if len(compilers) > 1 and '{arch}' not in args.publish:
+                raise Exception('--publish must contain {arch} when building several architectures!')
+
+            target = args.publish.replace('{arch}', getattr(compiler, 'arch', ''))
+            if target.startswith(('s3+http://', 's3+https://')):
+                if not os.environ.get('AWS_ACCESS_KEY_ID') or not os.environ.get('AWS_SECRET_ACCESS_KEY'):
+                    raise Exception('AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY must be set to publish to S3!')
+
+                compiler.setPublishTarget(FunnyFarmPublishTargetS3(target, os.environ['AWS_ACCESS_KEY_ID'], os.environ['AWS_SECRET_ACCESS_KEY'],
+                                                                   os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'), publishHeaders))
+            elif target.startswith(('http://', 'https://')):
+                compiler.setPublishTarget(FunnyFarmPublishTargetHTTP(target, publishHeaders))
+            else:
+                compiler.setPublishTarget(FunnyFarmPublishTargetLocal(os.path.abspath(target)))
+
+        if args.game or args.all:
+            compiler.addSourceDir('libotp')
+            compiler.addSourceDir('otp')
+            compiler.addSourceDir('toontown')
+            compiler.setMainFile(os.path.join(compiler.dataDir, 'funnyfarm.py'))
+            compiler.setConfigFile(os.path.join('config', 'release.prc'))
+
+    for compiler in compilers:
+        if args.analyze_duplicates:
+            compiler.run('analyzeDuplicates')
+
+        if args.watch:
+            # Watching starts with a build of its own and runs until stopped with Ctrl+C.
+            compiler.run('watch')
+        elif args.all:
+            compiler.run('buildAll')
+        else:
+            if args.game:
+                compiler.run('buildGame')
 
-args = parser.parse_args()
+            if args.resources:
+                compiler.run('buildResources')
 
-if sys.platform not in ('win32', 'darwin'):
-    raise Exception('Platform not supported: %s' % sys.platform)
+            if args.dist:
+                compiler.run('buildDist')
 
-if args.dist and not args.launcher:
-    raise Exception('Launcher version must be set to build distributables!')
+        if args.verify:
+            compiler.run('verify')
 
-if (args.game or args.dist or args.resources):
-    if sys.platform == 'win32':
-        compiler = FunnyFarmCompilerWindows(args.version, args.launcher, args.arch)
-    elif sys.platform == 'darwin':
-        compiler = FunnyFarmCompilerDarwin(args.version, args.launcher)
-
-if args.game:
-    compiler.addSourceDir('libotp')
-    compiler.addSourceDir('otp')
-    compiler.addSourceDir('toontown')
-    compiler.setMainFile(os.path.join(compiler.dataDir, 'funnyfarm.py'))
-    compiler.setConfigFile(os.path.join('config', 'release.prc'))
-    compiler.run('buildGame')
-
-if args.resources:
-    compiler.run('buildResources')
-
-if args.dist:
-    compiler.run('buildDist')
+        if args.publish:
+            compiler.run('publish')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,799 @@
+assert not __debug__  # Run with -OO: python -OO -m unittest test_make
+
+import http.server
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import urllib.parse
+
+from panda3d.core import Filename, Multifile
+
+from benchmark import FunnyFarmBenchmark
+import make
+from make import FunnyFarmCompilerBase, FunnyFarmFileWatcher, FunnyFarmMultifile, FunnyFarmPublishTargetHTTP, FunnyFarmPublishTargetS3
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+class FunnyFarmBuildTest(unittest.TestCase):
+    # Builds a small synthetic tree with the benchmark's stand-in tools.
+    eggs = False
+
+    class Options:
+        jobs = 2
+        incremental = True
+        codec = 'bz2'
+        manifest_format = 'files'
+        preprocess = False
+        hash_algorithm = 'md5'
+        packer = 'native'
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.rootDir = tempfile.mkdtemp(prefix='funnyfarm-test-')
+        self.benchmark = FunnyFarmBenchmark(self.rootDir, 0)
+        self.benchmark.generate(2, 1, 4, 1, 1, 0.5, self.eggs)
+        os.chdir(self.rootDir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.rootDir)
+
+    def build(self, command='buildAll', profileStartup=False, setup=None, **options):
+        # setup is called with the compiler before it runs, for settings the
+        # benchmark has no options for.
+        args = self.Options()
+        for name, value in options.items():
+            setattr(args, name, value)
+
+        compiler = self.benchmark.createCompiler(args)
+        compiler.setProfileStartup(profileStartup)
+        if setup:
+            setup(compiler)
+
+        compiler.run(command)
+        return compiler
+
+    def appendToFile(self, filepath, data):
+        with open(filepath, 'ab') as f:
+            f.write(data)
+
+    def readManifest(self, compiler):
+        with open(os.path.join(compiler.builtDir, 'dist', 'manifest.json'), 'r') as f:
+            return json.load(f)
+
+    def getSubfileNames(self, compiler, phase):
+        return sorted(FunnyFarmMultifile(os.path.join(compiler.builtDir, 'resources', phase + '.mf')).readIndex())
+
+
+class TestBuildAll(FunnyFarmBuildTest):
+
+    def testDeletedResourceIsRemovedFromPhase(self):
+        compiler = self.build()
+        self.assertIn('phase_3/models/model_0.bam', self.getSubfileNames(compiler, 'phase_3'))
+
+        os.remove(os.path.join(compiler.baseDir, 'resources', 'phase_3', 'models', 'model_0.bam'))
+        compiler = self.build()
+        self.assertNotIn('phase_3/models/model_0.bam', self.getSubfileNames(compiler, 'phase_3'))
+        # The distributables are rebuilt from the repacked phase too.
+        entry = self.readManifest(compiler)['files']['resources/phase_3.mf']
+        self.assertEqual(entry['hash'], compiler.getFileHash(os.path.join(compiler.builtDir, 'resources', 'phase_3.mf')))
+
+    def testChangedOptionsRebuildDist(self):
+        compiler = self.build()
+        self.assertEqual(self.readManifest(compiler)['hash-algorithm'], 'md5')
+
+        compiler = self.build(hash_algorithm='sha256', codec='xz')
+        manifest = self.readManifest(compiler)
+        self.assertEqual(manifest['hash-algorithm'], 'sha256')
+        for filepath, entry in manifest['files'].items():
+            self.assertEqual(entry['codec'], 'xz')
+            self.assertEqual(entry['hash'], compiler.getFileHash(os.path.join(compiler.builtDir, filepath), 'sha256'))
+
+        compiler.run('verify')
+
+    def getStagesRun(self, compiler):
+        return sorted(record['target'] for record in compiler.metrics.records if record['name'] == 'stage')
+
+    def testUpToDateStagesAreSkipped(self):
+        compiler = self.build()
+        self.assertEqual(self.getStagesRun(compiler), ['dist', 'game', 'resources'])
+        self.assertEqual(self.getStagesRun(self.build()), [])
+
+        self.appendToFile(os.path.join(compiler.baseDir, 'resources', 'phase_4', 'models', 'model_1.bam'), b'changed')
+        self.assertEqual(self.getStagesRun(self.build()), ['dist', 'resources'])
+
+        os.remove(os.path.join(compiler.baseDir, 'resources', 'phase_4', 'models', 'model_1.bam'))
+        self.assertEqual(self.getStagesRun(self.build()), ['dist', 'resources'])
+
+        self.assertEqual(self.getStagesRun(self.build(codec='xz')), ['dist'])
+        self.assertEqual(self.getStagesRun(self.build(codec='xz')), [])
+
+        # Outputs changed or removed since the last run are rebuilt too.
+        os.remove(os.path.join(compiler.builtDir, 'dist', 'binary_0.dll.xz'))
+        self.assertEqual(self.getStagesRun(self.build(codec='xz')), ['dist'])
+        # The game stage copies the binary back, so the distributables are still up to date.
+        self.appendToFile(os.path.join(compiler.builtDir, 'binary_0.dll'), b'changed')
+        self.assertEqual(self.getStagesRun(self.build(codec='xz')), ['game'])
+
+        self.assertEqual(self.getStagesRun(self.build(incremental=False, codec='xz')), ['dist', 'game', 'resources'])
+        compiler.run('verify')
+
+    def testChangedCompressionLevelRecompressesPhases(self):
+        def setLevel(level):
+            return lambda compiler: compiler.setMultifileCompressionLevel(level)
+
+        compiler = self.build('buildResources', setup=setLevel(1))
+        level1Size = os.path.getsize(os.path.join(compiler.builtDir, 'resources', 'phase_3.mf'))
+        compiler = self.build('buildResources', setup=setLevel(9))
+        level9Size = os.path.getsize(os.path.join(compiler.builtDir, 'resources', 'phase_3.mf'))
+
+        shutil.rmtree(compiler.builtDir)
+        compiler = self.build('buildResources', setup=setLevel(9))
+        self.assertNotEqual(level9Size, level1Size)
+        self.assertEqual(os.path.getsize(os.path.join(compiler.builtDir, 'resources', 'phase_3.mf')), level9Size)
+
+    def testCleanupKeepsHashCacheTempFiles(self):
+        # The resources stage may be saving its hash cache while the game stage cleans up.
+        compiler = self.build()
+        for filename in ('resources-hashcache.json.tmp', 'stale.py', 'stale.tmp'):
+            with open(os.path.join(compiler.workingDir, filename), 'w') as f:
+                f.write('{}')
+
+        compiler.removeOldBuildFiles()
+        self.assertTrue(os.path.exists(os.path.join(compiler.workingDir, 'resources-hashcache.json.tmp')))
+        self.assertFalse(os.path.exists(os.path.join(compiler.workingDir, 'stale.py')))
+        self.assertFalse(os.path.exists(os.path.join(compiler.workingDir, 'stale.tmp')))
+
+    def checkCompressedFile(self, compiler, filepath):
+        # Returns the problems found and how many times the compressed file was opened.
+        manifest = self.readManifest(compiler)
+        compressedPath = os.path.join(compiler.builtDir, 'dist', *(filepath + '.bz2').split('/'))
+        with unittest.mock.patch('builtins.open', wraps=open) as mockOpen:
+            problems, bytesRead, bytesVerified = compiler.checkFile(filepath, manifest['files'][filepath], manifest)
+
+        self.assertEqual(bytesRead, os.path.getsize(compressedPath))
+        return problems, len([call for call in mockOpen.call_args_list if call.args[0] == compressedPath])
+
+    def testVerifyReadsEachFileOnce(self):
+        compiler = self.build()
+        self.assertEqual(self.checkCompressedFile(compiler, 'resources/phase_3.mf'), ([], 1))
+
+        compressedPath = os.path.join(compiler.builtDir, 'dist', 'resources', 'phase_3.mf.bz2')
+        with open(compressedPath, 'rb') as f:
+            data = bytearray(f.read())
+
+        data[len(data) // 2] ^= 0xff
+        with open(compressedPath, 'wb') as f:
+            f.write(data)
+
+        self.assertEqual(self.checkCompressedFile(compiler, 'resources/phase_3.mf'),
+                         ([('corrupt', 'resources/phase_3.mf.bz2', 'compressed hash does not match')], 1))
+
+
+class TestMetrics(FunnyFarmBuildTest):
+
+    def readReports(self, compiler):
+        metricsDir = os.path.join(compiler.workingDir, 'metrics')
+        reports = []
+        for filename in sorted(os.listdir(metricsDir)):
+            with open(os.path.join(metricsDir, filename), 'r') as f:
+                reports.append(json.load(f))
+
+        return reports
+
+    def testFailedBuildWritesReport(self):
+        # A compiler that knows its version, but fails to compile anything.
+        failingCompiler = 'import sys\nif sys.argv[1:] == ["--version"]:\n    print("failing")\nelse:\n    sys.exit(1)\n'
+
+        def setup(compiler):
+            compiler.setCompilerCommand([sys.executable, '-c', failingCompiler])
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.build('buildGame', setup=setup)
+
+        report, = self.readReports(self.benchmark.createCompiler(self.Options()))
+        self.assertEqual(report['status'], 'failed')
+        self.assertIn('CalledProcessError', report['error'])
+        failedSteps = [record['name'] for record in report['steps'] if record.get('failed')]
+        self.assertEqual(failedSteps, ['buildGame', 'stage'])
+
+    def testEveryWatchRebuildWritesReport(self):
+        # One change to phase 3, then Ctrl+C.
+        modelPath = os.path.join(self.rootDir, 'Toontowns-Funny-Farm', 'resources', 'phase_3', 'models', 'model_0.bam')
+        changes = [{modelPath}, KeyboardInterrupt()]
+
+        def setup(compiler):
+            reportPaths = []
+            writeMetricsReport = compiler.writeMetricsReport
+
+            def writeReport(command, error=None):
+                reportPaths.append(writeMetricsReport(command, error))
+                time.sleep(1)  # Reports are named by the second they started in.
+                return reportPaths[-1]
+
+            compiler.writeMetricsReport = writeReport
+            compiler.reportPaths = reportPaths
+
+        with unittest.mock.patch('make.FunnyFarmFileWatcher.waitForChanges', side_effect=changes):
+            compiler = self.build('watch', setup=setup)
+
+        self.assertEqual(len(compiler.reportPaths), 2)
+        reports = self.readReports(compiler)
+        self.assertEqual([report['status'] for report in reports], ['succeeded', 'succeeded'])
+        self.assertEqual([report['command'] for report in reports], ['watch', 'watch'])
+        rebuiltPhases = [sorted(record['target'] for record in report['steps'] if record['name'] == 'hashTree') for report in reports]
+        self.assertEqual(rebuiltPhases[1], ['phase_3'])
+
+
+class TestGameFingerprint(FunnyFarmBuildTest):
+
+    def getSteps(self, compiler):
+        return [record['name'] for record in compiler.metrics.records]
+
+    def testUnchangedGameIsNotCompiled(self):
+        compiler = self.build('buildGame')
+        self.assertIn('buildGame', self.getSteps(compiler))
+        distDir = os.path.join(compiler.workingDir, 'funnyfarm.dist')
+        distMtime = os.stat(distDir).st_mtime_ns
+
+        compiler = self.build('buildGame')
+        self.assertNotIn('buildGame', self.getSteps(compiler))
+        self.assertNotIn('copyBuildFiles', self.getSteps(compiler))
+        self.assertEqual(os.stat(distDir).st_mtime_ns, distMtime)
+        # The built directory is still filled from the reused build.
+        self.assertTrue(os.path.exists(os.path.join(compiler.builtDir, 'binary_0.dll')))
+
+    def testChangesCompileTheGame(self):
+        self.build('buildGame')
+
+        def addFlag(compiler):
+            compiler.compilerFlags.append('--lto=no')
+
+        self.assertIn('buildGame', self.getSteps(self.build('buildGame', setup=addFlag)))
+        self.assertNotIn('buildGame', self.getSteps(self.build('buildGame', setup=addFlag)))
+
+        self.appendToFile(os.path.join(self.rootDir, 'Toontowns-Funny-Farm', 'toontown', 'toonbase', 'FunnyFarmStart.py'), b'# changed\n')
+        self.assertIn('buildGame', self.getSteps(self.build('buildGame', setup=addFlag)))
+
+        self.appendToFile(os.path.join(self.rootDir, 'Toontowns-Funny-Farm', 'config', 'release.prc'), b'want-changes #t\n')
+        self.assertIn('buildGame', self.getSteps(self.build('buildGame', setup=addFlag)))
+
+    def testCompilerUpgradeCompilesTheGame(self):
+        self.build('buildGame')
+
+        # A stand-in compiler reporting another version.
+        nuitkaPath = os.path.join(self.rootDir, 'nuitka')
+        with open(nuitkaPath, 'r') as f:
+            source = f.read()
+
+        with open(nuitkaPath, 'w') as f:
+            f.write(source.replace("print('stand-in')", "print('stand-in 2')"))
+
+        self.assertIn('buildGame', self.getSteps(self.build('buildGame')))
+
+    def testBuildCacheIsPreserved(self):
+        compiler = self.build('buildGame', incremental=False)
+        os.makedirs(os.path.join(compiler.workingDir, 'funnyfarm.build'))
+        compiler.removeOldBuildFiles()
+        self.assertTrue(os.path.exists(os.path.join(compiler.workingDir, 'funnyfarm.build')))
+
+
+class TestPreprocess(FunnyFarmBuildTest):
+    # Every other model is an .egg, converted by the stand-in egg2bam.
+    eggs = True
+
+    def readReport(self, compiler):
+        with open(os.path.join(compiler.workingDir, 'preprocess-report.json'), 'r') as f:
+            return json.load(f)
+
+    def testConversionCache(self):
+        compiler = self.build('buildResources', preprocess=True)
+        report = self.readReport(compiler)
+        self.assertEqual([(phase, entry['converted'], entry['cached']) for phase, entry in report.items()], [('phase_3', 2, 0), ('phase_4', 2, 0)])
+        self.assertEqual(self.getSubfileNames(compiler, 'phase_3'), ['phase_3/models/model_%d.bam' % i for i in range(4)])
+
+        # Unchanged assets are never converted again.
+        report = self.readReport(self.build('buildResources', preprocess=True))
+        self.assertEqual([(phase, entry['converted'], entry['cached']) for phase, entry in report.items()], [('phase_3', 0, 2), ('phase_4', 0, 2)])
+
+        # Converted files are cached by contents, so a copy in another phase is found
+        # in the cache too, and only the changed asset is converted.
+        modelsDir = os.path.join(compiler.baseDir, 'resources', 'phase_4', 'models')
+        shutil.copy(os.path.join(compiler.baseDir, 'resources', 'phase_3', 'models', 'model_1.egg'), os.path.join(modelsDir, 'copy.egg'))
+        self.appendToFile(os.path.join(modelsDir, 'model_3.egg'), b'changed')
+        report = self.readReport(self.build('buildResources', preprocess=True))
+        self.assertEqual([(phase, entry['converted'], entry['cached']) for phase, entry in report.items()], [('phase_3', 0, 2), ('phase_4', 1, 2)])
+
+    def testSavingsReport(self):
+        compiler = self.build('buildResources', preprocess=True)
+        for phase, entry in self.readReport(compiler).items():
+            modelsDir = os.path.join(compiler.baseDir, 'resources', phase, 'models')
+            stagedDir = os.path.join(compiler.workingDir, 'preprocessed', phase, 'models')
+            sourceSize = sum(os.path.getsize(os.path.join(modelsDir, 'model_%d.egg' % i)) for i in (1, 3))
+            convertedSize = sum(os.path.getsize(os.path.join(stagedDir, 'model_%d.bam' % i)) for i in (1, 3))
+            self.assertEqual((entry['sourceSize'], entry['convertedSize']), (sourceSize, convertedSize))
+            self.assertEqual(entry['saved'], sourceSize - convertedSize)
+            self.assertGreater(entry['saved'], 0)
+
+
+class TestDedupe(FunnyFarmBuildTest):
+
+    def setUp(self):
+        FunnyFarmBuildTest.setUp(self)
+        # phase_10 sorts before phase_4 by name, but loads after it.
+        self.resourcesDir = os.path.join(self.rootDir, 'Toontowns-Funny-Farm', 'resources')
+        modelPath = os.path.join(self.resourcesDir, 'phase_3', 'models', 'model_0.bam')
+        for relpath in ('phase_10/models/shared.bam', 'phase_4/maps/shared.bam', 'phase_10/maps/shared.bam'):
+            os.makedirs(os.path.dirname(os.path.join(self.resourcesDir, relpath)), exist_ok=True)
+            shutil.copy(os.path.join(self.resourcesDir, 'phase_4', 'models', 'model_1.bam'), os.path.join(self.resourcesDir, relpath))
+
+        shutil.copy(modelPath, os.path.join(self.resourcesDir, 'phase_10', 'models', 'launch.bam'))
+        self.modelSize = os.path.getsize(modelPath)
+        self.sharedSize = os.path.getsize(os.path.join(self.resourcesDir, 'phase_4', 'models', 'model_1.bam'))
+
+    def readRedirects(self, compiler, phase):
+        multifile = Multifile()
+        self.assertTrue(multifile.openRead(Filename.fromOsSpecific(os.path.join(compiler.builtDir, 'resources', phase + '.mf'))))
+        try:
+            index = multifile.findSubfile('%s/%s' % (phase, make.DEDUPE_REDIRECTS_NAME))
+            return json.loads(multifile.readSubfile(index).decode('utf-8')) if index >= 0 else {}
+        finally:
+            multifile.close()
+
+    def testDuplicateGroups(self):
+        compiler = self.build('analyzeDuplicates')
+        with open(os.path.join(compiler.workingDir, 'duplicates.json'), 'r') as f:
+            report = json.load(f)
+
+        groups = sorted((group['size'], group['wasted'], group['files']) for group in report['groups'])
+        self.assertEqual(groups, sorted([
+            (self.modelSize, self.modelSize, ['phase_3/models/model_0.bam', 'phase_10/models/launch.bam']),
+            (self.sharedSize, 3 * self.sharedSize, ['phase_4/maps/shared.bam', 'phase_4/models/model_1.bam',
+                                                    'phase_10/maps/shared.bam', 'phase_10/models/shared.bam'])]))
+        self.assertEqual(report['wasted'], self.modelSize + 3 * self.sharedSize)
+        # A copy within one phase wastes space, but isn't shared between phases.
+        pairs = {tuple(pair['phases']): pair['wasted'] for pair in report['phasePairs']}
+        self.assertEqual(pairs, {('phase_3', 'phase_10'): self.modelSize, ('phase_4', 'phase_10'): self.sharedSize})
+
+    def testDuplicatesArePackedByLoadOrder(self):
+        compiler = self.build('buildResources', setup=lambda compiler: compiler.setDedupeResources(True))
+        # Every duplicate is kept in the first phase loading it, with copies inside that phase kept as they are.
+        self.assertEqual(self.getSubfileNames(compiler, 'phase_10'), ['phase_10/' + make.DEDUPE_REDIRECTS_NAME])
+        self.assertIn('phase_4/maps/shared.bam', self.getSubfileNames(compiler, 'phase_4'))
+        self.assertIn('phase_4/models/model_1.bam', self.getSubfileNames(compiler, 'phase_4'))
+        self.assertEqual(self.readRedirects(compiler, 'phase_10'), {
+            'phase_10/maps/shared.bam': 'phase_4/maps/shared.bam',
+            'phase_10/models/launch.bam': 'phase_3/models/model_0.bam',
+            'phase_10/models/shared.bam': 'phase_4/maps/shared.bam'
+        })
+        self.assertEqual(self.readRedirects(compiler, 'phase_4'), {})
+
+        # Without the duplicates, phase_10 is packed in full again.
+        compiler = self.build('buildResources')
+        self.assertEqual(self.getSubfileNames(compiler, 'phase_10'), ['phase_10/maps/shared.bam', 'phase_10/models/launch.bam', 'phase_10/models/shared.bam'])
+
+
+class TestDeltaPatches(FunnyFarmBuildTest):
+
+    def getPatchFiles(self, compiler):
+        patchFiles = []
+        for dirpath, dirnames, filenames in os.walk(os.path.join(compiler.builtDir, 'dist')):
+            patchFiles += [filename for filename in filenames if filename.endswith('.patch')]
+
+        return sorted(patchFiles)
+
+    def buildRelease(self, release):
+        # Builds against a copy of the previous release, made before it is overwritten.
+        previousDir = os.path.join(self.rootDir, 'release-%d' % (release - 1))
+        shutil.copytree(os.path.join(self.rootDir, 'builds', 'ff-v1.0.0', 'built'), previousDir)
+        self.appendToFile(os.path.join(self.rootDir, 'Toontowns-Funny-Farm', 'resources', 'phase_3', 'models', 'model_0.bam'), b'release %d' % release)
+
+        def setup(compiler):
+            compiler.setDeltaFrom(previousDir)
+            compiler.setPatchLargeSize(0)
+
+        return self.build(setup=setup)
+
+    def testLargeFilesArePatchedAndStalePatchesRemoved(self):
+        self.build()
+        compiler = self.buildRelease(2)
+        patch = self.readManifest(compiler)['files']['resources/phase_3.mf']['patch']
+        # Every file is over the large size, so they are diffed one at a time instead of skipped.
+        self.assertEqual(self.getPatchFiles(compiler), [patch['filename']])
+
+        compiler = self.buildRelease(3)
+        newPatch = self.readManifest(compiler)['files']['resources/phase_3.mf']['patch']
+        self.assertNotEqual(newPatch['from'], patch['from'])
+        self.assertEqual(self.getPatchFiles(compiler), [newPatch['filename']])
+        compiler.run('verify')
+
+
+class TestProfileStartup(FunnyFarmBuildTest):
+
+    def setUp(self):
+        FunnyFarmBuildTest.setUp(self)
+        shutil.copy(os.path.join(DATA_DIR, 'funnyfarmprofile.py'), os.path.join(self.rootDir, 'data'))
+
+    def readMainFile(self, compiler):
+        with open(os.path.join(compiler.workingDir, 'funnyfarm.py'), 'r') as f:
+            return f.read()
+
+    def testRealEntryPointIsInstrumented(self):
+        compiler = FunnyFarmCompilerBase('ff-test', 'test')
+        compiler.setMainFile(os.path.join(DATA_DIR, 'funnyfarm.py'))
+        compiler.dataDir = DATA_DIR
+        compiler.setProfileStartup(True)
+        source = compiler.getEntryPointSource()
+        compile(source, 'funnyfarm.py', 'exec')
+        with open(os.path.join(DATA_DIR, 'funnyfarm.py'), 'r') as f:
+            for line in f.read().splitlines():
+                if line and not line.startswith('#'):
+                    self.assertIn(line, source)
+
+    def testTogglingProfilingRebuildsTheGame(self):
+        compiler = self.build('buildGame')
+        production = self.readMainFile(compiler)
+        self.assertNotIn('profileMark', production)
+
+        compiler = self.build('buildGame', profileStartup=True)
+        self.assertIn(production + "profileMark('line 1: import toontown.toonbase.FunnyFarmStart', profileStepStart)\n",
+                      self.readMainFile(compiler))
+
+        # Later edits to the real entry point make it into profiling builds.
+        with open(os.path.join(compiler.dataDir, 'funnyfarm.py'), 'a') as f:
+            f.write('STARTED = True\n')
+
+        compiler = self.build('buildGame', profileStartup=True)
+        self.assertIn("profileMark('line 2: STARTED = True', profileStepStart)", self.readMainFile(compiler))
+
+        compiler = self.build('buildGame')
+        self.assertNotIn('profileMark', self.readMainFile(compiler))
+
+    def testImportRunningAtFirstFrameIsLogged(self):
+        # The game's start module stands in for the main loop, which never returns.
+        with open(os.path.join(self.rootDir, 'Toontowns-Funny-Farm', 'toontown', 'toonbase', 'FunnyFarmStart.py'), 'w') as f:
+            f.write('import sys\nsys.modules[\'__main__\'].profileWriteLog(0.5)\n')
+
+        compiler = self.build('buildGame', profileStartup=True)
+        subprocess.check_call([sys.executable, 'funnyfarm.py'], cwd=compiler.workingDir)
+        with open(os.path.join(compiler.workingDir, 'startup-profile.log'), 'r') as f:
+            log = f.read()
+
+        self.assertIn('first frame', log)
+        self.assertIn('toontown.toonbase.FunnyFarmStart (still importing)', log)
+
+
+class PublishRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def getFailure(self, name):
+        with self.server.lock:
+            self.server.requests.append((self.command, name))
+            failures = self.server.failures.get(name)
+            if failures:
+                return failures.pop(0)
+
+    def do_GET(self):
+        name = self.server.getName(self.path)
+        status = self.getFailure(name)
+        if status:
+            self.respond(status)
+        elif name in self.server.objects:
+            self.respond(200, self.server.objects[name])
+        else:
+            self.respond(self.server.missingStatus)
+
+    def do_PUT(self):
+        name = self.server.getName(self.path)
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        status = self.getFailure(name)
+        if status:
+            self.respond(status)
+        else:
+            self.server.objects[name] = data
+            self.respond(200)
+
+
+class PublishServer(http.server.ThreadingHTTPServer):
+    # Stands in for a web server or bucket that accepts PUT uploads. Requests
+    # are recorded in order, and failures lists the statuses to answer an
+    # object's next requests with.
+    daemon_threads = True
+
+    def __init__(self):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), PublishRequestHandler)
+        self.url = 'http://127.0.0.1:%d/ff' % self.server_address[1]
+        self.objects = {}
+        self.requests = []
+        self.failures = {}
+        self.missingStatus = 404
+        self.lock = threading.Lock()
+
+    def getName(self, path):
+        return urllib.parse.unquote(path[len('/ff/'):])
+
+    def getUploads(self):
+        return [name for method, name in self.requests if method == 'PUT']
+
+
+class TestPublish(FunnyFarmBuildTest):
+
+    def setUp(self):
+        FunnyFarmBuildTest.setUp(self)
+        self.server = PublishServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        retryDelay = unittest.mock.patch('make.PUBLISH_RETRY_DELAY', 0.01)
+        retryDelay.start()
+        self.addCleanup(retryDelay.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        FunnyFarmBuildTest.tearDown(self)
+
+    def buildAndPublish(self, changed=None, publishTarget=None):
+        # Rebuilds with a resource changed, if given, and clears the request log
+        # before publishing, so only the publish's requests are in it.
+        if changed:
+            self.appendToFile(os.path.join(self.rootDir, 'Toontowns-Funny-Farm', 'resources', changed), b'changed')
+
+        publishTarget = publishTarget or FunnyFarmPublishTargetHTTP(self.server.url)
+        compiler = self.build(setup=lambda compiler: compiler.setPublishTarget(publishTarget))
+        self.server.requests = []
+        compiler.run('publish')
+        return compiler
+
+    def readDistFile(self, compiler, name):
+        with open(os.path.join(compiler.builtDir, 'dist', *name.split('/')), 'rb') as f:
+            return f.read()
+
+    def getPublishKey(self, compiler, name):
+        return compiler.getPublishObjects(self.readManifest(compiler))[name]
+
+    def checkPublished(self, compiler):
+        # Everything the local manifest refers to is on the server, byte for byte.
+        manifest = self.readManifest(compiler)
+        self.assertEqual(self.server.objects['manifest.json'], self.readDistFile(compiler, 'manifest.json'))
+        for name, key in compiler.getPublishObjects(manifest).items():
+            self.assertEqual(self.server.objects[key], self.readDistFile(compiler, name))
+
+    def testFirstPublishUploadsEverythingManifestLast(self):
+        compiler = self.buildAndPublish()
+        self.assertEqual(self.server.requests[0], ('GET', 'manifest.json'))
+        uploads = self.server.getUploads()
+        self.assertEqual(uploads[-1], 'manifest.json')
+        self.assertEqual(sorted(uploads[:-1]), sorted(set(compiler.getPublishObjects(self.readManifest(compiler)).values())))
+        self.checkPublished(compiler)
+
+    def testOnlyChangedObjectsAreRepublished(self):
+        compiler = self.buildAndPublish()
+        oldKey = self.getPublishKey(compiler, 'resources/phase_3.mf.bz2')
+        oldObjects = dict(self.server.objects)
+
+        compiler = self.buildAndPublish('phase_3/models/model_0.bam')
+        newKey = self.getPublishKey(compiler, 'resources/phase_3.mf.bz2')
+        self.assertNotEqual(newKey, oldKey)
+        self.assertEqual(self.server.getUploads(), [newKey, 'manifest.json'])
+        self.checkPublished(compiler)
+        # Nothing the old manifest refers to was overwritten, for clients still using it.
+        for key, data in oldObjects.items():
+            if key != 'manifest.json':
+                self.assertEqual(self.server.objects[key], data)
+
+        self.buildAndPublish()
+        self.assertEqual(self.server.getUploads(), ['manifest.json'])
+
+    def testServerErrorsAreRetried(self):
+        compiler = self.build()
+        key = self.getPublishKey(compiler, 'resources/phase_3.mf.bz2')
+        self.server.failures[key] = [503, 500, 429]
+        compiler = self.buildAndPublish()
+        self.assertEqual(self.server.getUploads().count(key), 4)
+        self.checkPublished(compiler)
+
+    def testFailedUploadKeepsOldManifest(self):
+        self.buildAndPublish()
+        oldManifest = self.server.objects['manifest.json']
+        self.appendToFile(os.path.join(self.rootDir, 'Toontowns-Funny-Farm', 'resources', 'phase_3', 'models', 'model_0.bam'), b'changed')
+        key = self.getPublishKey(self.build(), 'resources/phase_3.mf.bz2')
+        self.server.failures[key] = [500] * (make.PUBLISH_RETRIES + 1)
+        with self.assertRaises(Exception):
+            self.buildAndPublish()
+
+        self.assertEqual(self.server.getUploads(), [key] * (make.PUBLISH_RETRIES + 1))
+        self.assertEqual(self.server.objects['manifest.json'], oldManifest)
+
+    def testLegacyManifestIsPublishedInPlace(self):
+        # Manifests written before the object store keep their old layout.
+        compiler = self.build()
+        manifest = self.readManifest(compiler)
+        del manifest['object-store']
+        with open(os.path.join(compiler.builtDir, 'dist', 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+        compiler.setPublishTarget(FunnyFarmPublishTargetHTTP(self.server.url))
+        compiler.run('publish')
+        self.assertIn('resources/phase_3.mf.bz2', self.server.getUploads())
+        self.checkPublished(compiler)
+
+    def testForbiddenManifestIsMissingOnS3(self):
+        # S3 without list permission on the bucket.
+        self.server.missingStatus = 403
+        compiler = self.buildAndPublish(publishTarget=FunnyFarmPublishTargetS3(self.server.url, 'access', 'secret'))
+        self.assertEqual(self.server.getUploads()[-1], 'manifest.json')
+        self.checkPublished(compiler)
+
+        publishTarget = FunnyFarmPublishTargetHTTP(self.server.url)
+        self.addCleanup(publishTarget.close)
+        with self.assertRaises(IOError):
+            publishTarget.readFile('missing')
+
+
+class TestMultifile(unittest.TestCase):
+    # The native writer is checked against Panda3D's own multifile reader.
+
+    def setUp(self):
+        self.rootDir = tempfile.mkdtemp(prefix='funnyfarm-test-')
+        self.random = random.Random(0)
+        self.files = {
+            'phase_3/models/model.bam': self.random.getrandbits(8 * 4096).to_bytes(4096, 'little') + b'model' * 100000,
+            'phase_3/maps/texture.jpg': self.random.getrandbits(8 * 65536).to_bytes(65536, 'little'),
+            'phase_3/audio/empty.ogg': b'',
+            'phase_3/etc/large.txt': b'Toontown\'s Funny Farm\n' * 200000
+        }
+        for name, data in self.files.items():
+            self.writeFile(name, data)
+
+    def tearDown(self):
+        shutil.rmtree(self.rootDir)
+
+    def writeFile(self, name, data):
+        filepath = os.path.join(self.rootDir, *name.split('/'))
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as f:
+            f.write(data)
+
+    def getSubfiles(self, level):
+        # Like the compiler, already compressed media is always stored.
+        return [(name, os.path.join(self.rootDir, *name.split('/')), 0 if name.endswith(('.jpg', '.ogg')) else level)
+                for name in sorted(self.files)]
+
+    def readWithPanda(self, filepath):
+        multifile = Multifile()
+        self.assertTrue(multifile.openRead(Filename.fromOsSpecific(filepath)))
+        subfiles = {}
+        for i in range(multifile.getNumSubfiles()):
+            subfiles[multifile.getSubfileName(i)] = (multifile.readSubfile(i), multifile.isSubfileCompressed(i), multifile.getSubfileTimestamp(i))
+
+        multifile.close()
+        return subfiles
+
+    def checkMultifile(self, filepath, level):
+        subfiles = self.readWithPanda(filepath)
+        self.assertEqual(sorted(subfiles), sorted(self.files))
+        for name, sourcePath, compressionLevel in self.getSubfiles(level):
+            data, compressed, timestamp = subfiles[name]
+            self.assertEqual(data, self.files[name])
+            self.assertEqual(compressed, bool(compressionLevel))
+            self.assertEqual(timestamp, int(os.path.getmtime(sourcePath)))
+
+    def testStoredRoundTrip(self):
+        filepath = os.path.join(self.rootDir, 'stored.mf')
+        FunnyFarmMultifile(filepath).write(self.getSubfiles(0))
+        self.checkMultifile(filepath, 0)
+
+    def testCompressedRoundTrip(self):
+        filepath = os.path.join(self.rootDir, 'compressed.mf')
+        FunnyFarmMultifile(filepath).write(self.getSubfiles(6))
+        self.checkMultifile(filepath, 6)
+        self.assertLess(os.path.getsize(filepath), sum(len(data) for data in self.files.values()))
+
+    def testIndexMatchesPanda(self):
+        filepath = os.path.join(self.rootDir, 'index.mf')
+        FunnyFarmMultifile(filepath).write(self.getSubfiles(6))
+        index = FunnyFarmMultifile(filepath).readIndex()
+        multifile = Multifile()
+        self.assertTrue(multifile.openRead(Filename.fromOsSpecific(filepath)))
+        for i in range(multifile.getNumSubfiles()):
+            entry = index[multifile.getSubfileName(i)]
+            self.assertEqual(entry['start'], multifile.getSubfileInternalStart(i))
+            self.assertEqual(entry['length'], multifile.getSubfileInternalLength(i))
+            self.assertEqual(entry['uncompressedLength'], multifile.getSubfileLength(i))
+
+        multifile.close()
+
+    def testRewriteReusesUnchangedSubfiles(self):
+        filepath = os.path.join(self.rootDir, 'reuse.mf')
+        FunnyFarmMultifile(filepath).write(self.getSubfiles(6))
+
+        # Same size, and within the same second as far as subfile timestamps go.
+        self.files['phase_3/models/model.bam'] = self.files['phase_3/models/model.bam'][::-1]
+        self.writeFile('phase_3/models/model.bam', self.files['phase_3/models/model.bam'])
+        stat = os.stat(filepath)
+        os.utime(os.path.join(self.rootDir, 'phase_3', 'models', 'model.bam'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        time.sleep(0.01)
+
+        reused = FunnyFarmMultifile(filepath).write(self.getSubfiles(6), filepath, 6)
+        self.assertEqual(reused, len(self.files) - 1)
+        self.checkMultifile(filepath, 6)
+
+    def testRewriteAtAnotherLevelRecompresses(self):
+        filepath = os.path.join(self.rootDir, 'level.mf')
+        FunnyFarmMultifile(filepath).write(self.getSubfiles(1), None)
+        time.sleep(0.01)
+
+        # Only the stored media can be reused, the rest is compressed again at the new level.
+        reused = FunnyFarmMultifile(filepath).write(self.getSubfiles(9), filepath, 1)
+        self.assertEqual(reused, 2)
+        self.checkMultifile(filepath, 9)
+        freshFilepath = os.path.join(self.rootDir, 'fresh.mf')
+        FunnyFarmMultifile(freshFilepath).write(self.getSubfiles(9))
+        self.assertEqual(os.path.getsize(filepath), os.path.getsize(freshFilepath))
+
+
+class TestFileWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.rootDir = os.path.realpath(tempfile.mkdtemp(prefix='funnyfarm-test-'))
+        self.modelsDir = os.path.join(self.rootDir, 'resources', 'phase_3', 'models')
+        os.makedirs(self.modelsDir)
+        self.modelPath = os.path.join(self.modelsDir, 'model.bam')
+        self.configPath = os.path.join(self.rootDir, 'release.prc')
+        for filepath in (self.modelPath, self.configPath, os.path.join(self.rootDir, 'other.txt')):
+            with open(filepath, 'w') as f:
+                f.write('original')
+
+    def tearDown(self):
+        shutil.rmtree(self.rootDir)
+
+    def checkWatcher(self, watcher):
+        watcher.start()
+        try:
+            with open(self.modelPath, 'r') as f:
+                f.read()
+
+            self.assertEqual(watcher.readChanges(0.5), set())
+
+            with open(self.modelPath, 'w') as f:
+                f.write('changed')
+            with open(self.configPath, 'w') as f:
+                f.write('changed, and longer')
+            with open(os.path.join(self.rootDir, 'other.txt'), 'w') as f:
+                f.write('changed')
+
+            self.assertEqual(watcher.waitForChanges(0.5) - {self.modelsDir}, {self.modelPath, self.configPath})
+        finally:
+            watcher.close()
+
+    @unittest.skipUnless(make.Observer, 'watchdog is not installed')
+    def testNative(self):
+        watcher = FunnyFarmFileWatcher([os.path.join(self.rootDir, 'resources'), self.configPath])
+        self.checkWatcher(watcher)
+
+    def testPolling(self):
+        with unittest.mock.patch('make.Observer', None):
+            watcher = FunnyFarmFileWatcher([os.path.join(self.rootDir, 'resources'), self.configPath], 0.1)
+            self.checkWatcher(watcher)
+            self.assertIsNone(watcher.observer)
+
+
+if __name__ == '__main__':
+    unittest.main()